@@ -23,19 +23,46 @@ from __future__ import print_function
 import os
 import sys
 import argparse
+import atexit
+import copy
+import glob
 import json
 import time, datetime
 import signal
-import subprocess
-from collections import defaultdict
-from distutils.spawn import find_executable
+import threading
+import hashlib
+import heapq
+import re
+import random
+import struct
+import zlib
+from collections import defaultdict, deque
+import socket
+import select
 from socket import gethostname
 
+## for the scheduler, so changing the clock doesn't move the ticks. 2.7 only has the wall clock.
+monotonic = getattr(time, 'monotonic', time.time)
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 PROG_START = time.time()
 
 '''
     Requires pymysql, colorama, and situationally yaml and argcomplete
 
+    Startup matters, mypsl.py -i gets run from cron and alerting hooks a lot. Anything only some options
+    need is imported once we know the options need it (see the bottom of the file), and nothing
+    talks to the server until the first tick. mypsl_bench.py startup shows where the time goes.
+
     argcomplete is supported here as well, if the module is installed. See:
     https://pypi.python.org/pypi/argcomplete for specific information about argcomplete.
     How this is used is explained below.
@@ -68,83 +95,277 @@ PROG_START = time.time()
 
 '''
 
-try:
-    import pymysql
-    HAS_MYSQL = True
-except ImportError:
-    HAS_MYSQL = False
-
-try:
-    import argcomplete
-    HAS_ARGCOMPLETE = True
-except ImportError:
-    HAS_ARGCOMPLETE = False
-
-try:
-    from colorama import init, Fore, Style
-    HAS_COLOR = True
-except ImportError:
-    HAS_COLOR = False
-
-## not all have this by default...
-try:
-    import yaml
-    HAS_YAML = True
-except ImportError:
-    HAS_YAML = False
+## argcomplete sets this when it's the one running us, otherwise there's nothing to complete.
+HAS_ARGCOMPLETE = False
+if '_ARGCOMPLETE' in os.environ:
+    try:
+        import argcomplete
+        HAS_ARGCOMPLETE = True
+    except ImportError:
+        pass
+
+## colors are only for a terminal
+HAS_COLOR = False
+if sys.stdout.isatty():
+    try:
+        from colorama import init, Fore, Style
+        HAS_COLOR = True
+    except ImportError:
+        pass
 
 PROCESS_THRESHOLD_WARN  = 100
 PROCESS_THRESHOLD_CRIT  = 200
 SLEEPER_THRESHOLD_WARN  = 30
 SLEEPER_THRESHOLD_CRIT  = 75
 INFO_TRIM_LENGTH        = 1000
-
-USER_WHERE      = []
-HOSTNAME        = None
+TIMINGS_WINDOW          = 300
+OUTPUT_BUFFER_BYTES     = 1024 * 1024
+HISTORY_INFO_LENGTH     = 100
+SCHEDULE_BACKOFF        = 1.5       ## --loop_max: how much longer the interval gets each calm tick
+SCHEDULE_LATE           = 0.1       ## a tick starting more than this part of the interval after it was due is late
+
+USER_WHERE      = ''
+KILL_LOG        = None
+KILL_LOG_LOCK   = threading.Lock()
+RECORDER        = None
+POLICY          = None
+SCHEDULER       = None
 OUT_FORMAT      = "{0:<12}{1:16}{2:20}{3:22}{4:25}{5:<8}{6:28}{7:25}"
+OUT_TITLES      = ("ID", "USER", "HOST", "DB", "COMMAND", "TIME", "STATE", "INFO")
 MYPSL_CONFIGS   = os.path.join(os.environ.get('HOME'), '.mypsl')
+DEFAULTS_CACHE  = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.environ.get('HOME'), '.cache'), 'mypsl', 'my_cnf.json')
+
+## the status we need every tick, sent in the same round trip as the process list.
+SNAPSHOT_STATUS_SQL     = "SHOW GLOBAL STATUS WHERE Variable_name IN ('Threads_connected', 'Threads_running')"
+
+## server values that rarely change. They ride along with the snapshot only once their ttl has run out.
+METADATA = (
+    ## key                  expression                      ttl (seconds)
+    ('max_connections',     '@@global.max_connections',     60),
+    ('long_query_time',     '@@global.long_query_time',     30),
+    ('hostname',            '@@hostname',                   3600),
+    ('version',             '@@version',                    3600),
+    ('version_comment',     '@@version_comment',            3600),
+)
+METADATA_GENERATION     = 0
+
+## the keys every process list row has, whatever source it came from.
+PROCESS_FIELDS  = ('id', 'user', 'host', 'db', 'command', 'time', 'state', 'info')
+PREPARED_NAME   = 'mypsl_pslist'
+
+## when trimming, the server only sends the start of info, plus its length and first word so nothing else needs the full text.
+## the first word only ever comes from the start of the query, so there's no need to clean up the whole thing.
+INFO_KEYWORD    = "LOWER(SUBSTRING_INDEX(TRIM(REPLACE(REPLACE(REPLACE(LEFT({info}, 64), '\\r', ' '), '\\n', ' '), '\\t', ' ')), ' ', 1))"
+TRIMMED_INFO    = (
+    ('info',            "LEFT({{info}}, {0})".format(INFO_TRIM_LENGTH)),
+    ('info_length',     "CHAR_LENGTH({info})"),
+    ('info_keyword',    INFO_KEYWORD),
+)
+
+## what the errors from KILL mean for the thread we were after
+KILL_OUTCOMES           = {
+    1094:   'gone',     ## Unknown thread id
+    1095:   'denied',   ## You are not owner of thread
+    1227:   'denied',   ## Access denied; you need the SUPER/CONNECTION_ADMIN privilege
+}
+CONNECTION_LOST_ERRORS  = (2006, 2013, 2055)
+
+## reconnecting: the wait after the nth failure in a row is a random part of min(BASE * 2^n, MAX) seconds,
+## so a fleet of mypsl's doesn't hit a server that just came back all at once.
+RECONNECT_BACKOFF_BASE  = 0.5
+RECONNECT_BACKOFF_MAX   = 30
+RECONNECT_ATTEMPTS      = 3     ## when not looping, how many before giving up
+KEEPALIVE_INTERVAL      = 30    ## ping connections that have been idle this long between ticks
+
+## the numeric stats process_row() works out each tick, in the order they're printed.
+STAT_KEYS       = ('num_processes', 'num_sleepers', 'num_locked', 'num_reads', 'num_writes', 'num_closing', 'num_opening', 'num_past_long_query')
 
 READ_SEARCH     = ('show', 'select', 'desc')
 WRITE_SEARCH    = ('insert', 'update', 'create', 'alter', 'replace', 'rename', 'delete')
 LOCKED_SEARCH   = ('locked', 'waiting for table level lock', 'waiting for table metadata lock')
 
-class mydb():
-    conn            = None
-    cursor          = None
-    connect_args    = {}
-
-    def __init__(self):
-        socket = None
+def sql_list(values):
+    return "({0})".format(', '.join("'{0}'".format(v) for v in values))
+
+def sql_count(condition):
+    return "SUM(CASE WHEN {0} THEN 1 ELSE 0 END)".format(condition)
+
+## --stats: what process_row() works out for each row, worked out by the server and summed per user instead.
+## No LIKEs, a % in here would be taken for a parameter.
+STATS_SQL       = (
+    ('num_processes',       "COUNT(*)"),
+    ('num_sleepers',        sql_count("{command} = 'Sleep' OR LOCATE('sleep', LOWER({state})) > 0")),
+    ('num_locked',          sql_count("LOWER({state}) IN " + sql_list(LOCKED_SEARCH))),
+    ('num_reads',           sql_count(INFO_KEYWORD + " IN " + sql_list(READ_SEARCH))),
+    ('num_writes',          sql_count(INFO_KEYWORD + " IN " + sql_list(WRITE_SEARCH)) + " + " + \
+                                sql_count("{state} = 'Copying to tmp table on disk'")),
+    ('num_closing',         sql_count("LEFT({state}, 13) = 'closing table'")),
+    ('num_opening',         sql_count("LEFT({state}, 13) = 'Opening table'")),
+    ('num_past_long_query', sql_count("{time} > @@global.long_query_time")),
+)
+
+## --locks: who waits on whom, by process list id. Row locks come from performance_schema.data_lock_waits on 8.0,
+## and the innodb_lock_waits it replaced before that.
+ROW_LOCK_WAITS_SQL      = """SELECT r.PROCESSLIST_ID AS waiting, b.PROCESSLIST_ID AS blocking, 'row' AS kind
+    FROM performance_schema.data_lock_waits w
+    JOIN performance_schema.threads r ON r.THREAD_ID = w.REQUESTING_THREAD_ID
+    JOIN performance_schema.threads b ON b.THREAD_ID = w.BLOCKING_THREAD_ID"""
+INNODB_LOCK_WAITS_SQL   = """SELECT r.trx_mysql_thread_id AS waiting, b.trx_mysql_thread_id AS blocking, 'row' AS kind
+    FROM information_schema.innodb_lock_waits w
+    JOIN information_schema.innodb_trx r ON r.trx_id = w.requesting_trx_id
+    JOIN information_schema.innodb_trx b ON b.trx_id = w.blocking_trx_id"""
+## a pending metadata lock waits on the granted ones on the same object whose type it can't coexist with, the
+## server's compatibility matrix (mdl.cc). That's how one long SELECT ends up holding an ALTER, with every query on the
+## table queued up behind that. Only the holders count, like sys.schema_table_lock_waits, not what's queued ahead.
+MDL_CONFLICTS           = {
+    'INTENTION_EXCLUSIVE':      ('SHARED', 'EXCLUSIVE'),    ## scope locks, against FLUSH TABLES WITH READ LOCK's
+    'SHARED':                   ('INTENTION_EXCLUSIVE', 'EXCLUSIVE'),
+    'SHARED_HIGH_PRIO':         ('EXCLUSIVE',),
+    'SHARED_READ':              ('SHARED_NO_READ_WRITE', 'EXCLUSIVE'),
+    'SHARED_WRITE':             ('SHARED_READ_ONLY', 'SHARED_NO_WRITE', 'SHARED_NO_READ_WRITE', 'EXCLUSIVE'),
+    'SHARED_WRITE_LOW_PRIO':    ('SHARED_READ_ONLY', 'SHARED_NO_WRITE', 'SHARED_NO_READ_WRITE', 'EXCLUSIVE'),
+    'SHARED_UPGRADABLE':        ('SHARED_UPGRADABLE', 'SHARED_NO_WRITE', 'SHARED_NO_READ_WRITE', 'EXCLUSIVE'),
+    'SHARED_READ_ONLY':         ('SHARED_WRITE', 'SHARED_WRITE_LOW_PRIO', 'SHARED_NO_READ_WRITE', 'EXCLUSIVE'),
+    'SHARED_NO_WRITE':          ('SHARED_WRITE', 'SHARED_WRITE_LOW_PRIO', 'SHARED_UPGRADABLE', 'SHARED_NO_WRITE',
+                                 'SHARED_NO_READ_WRITE', 'EXCLUSIVE'),
+    'SHARED_NO_READ_WRITE':     ('SHARED_READ', 'SHARED_WRITE', 'SHARED_WRITE_LOW_PRIO', 'SHARED_UPGRADABLE', 'SHARED_READ_ONLY',
+                                 'SHARED_NO_WRITE', 'SHARED_NO_READ_WRITE', 'EXCLUSIVE'),
+    'EXCLUSIVE':                ('INTENTION_EXCLUSIVE', 'SHARED', 'SHARED_HIGH_PRIO', 'SHARED_READ', 'SHARED_WRITE', 'SHARED_WRITE_LOW_PRIO',
+                                 'SHARED_UPGRADABLE', 'SHARED_READ_ONLY', 'SHARED_NO_WRITE', 'SHARED_NO_READ_WRITE', 'EXCLUSIVE'),
+}
+METADATA_LOCK_WAITS_SQL = """SELECT r.PROCESSLIST_ID AS waiting, b.PROCESSLIST_ID AS blocking, 'metadata' AS kind
+    FROM performance_schema.metadata_locks w
+    JOIN performance_schema.metadata_locks g ON g.OBJECT_TYPE = w.OBJECT_TYPE AND g.OBJECT_SCHEMA <=> w.OBJECT_SCHEMA
+        AND g.OBJECT_NAME <=> w.OBJECT_NAME AND g.OWNER_THREAD_ID != w.OWNER_THREAD_ID
+        AND g.LOCK_STATUS = 'GRANTED' AND (w.LOCK_TYPE, g.LOCK_TYPE) IN ({0})
+    JOIN performance_schema.threads r ON r.THREAD_ID = w.OWNER_THREAD_ID
+    JOIN performance_schema.threads b ON b.THREAD_ID = g.OWNER_THREAD_ID
+    WHERE w.LOCK_STATUS = 'PENDING' AND b.PROCESSLIST_ID IS NOT NULL""".format(
+        ', '.join("('{0}', '{1}')".format(want, held) for (want, conflicts) in sorted(MDL_CONFLICTS.items()) for held in conflicts))
+
+def connection_lost(e):
+    ## InterfaceError is pymysql finding the connection already closed
+    return isinstance(e, pymysql.InterfaceError) or (e.args and e.args[0] in CONNECTION_LOST_ERRORS)
 
+class mydb():
+    '''
+        One connection to a server, and everything that belongs to its session.
+        Once connected, a lost connection is reconnected with jittered exponential backoff: when looping,
+        for as long as it takes, so a switchover only costs the ticks while the server was gone.
+        Idle connections are pinged between ticks (keepalive()) so they're still there when needed.
+    '''
+    conn                = None
+    cursor              = None
+    connect_args        = {}
+    num_queries         = 0
+    host                = None
+    port                = None
+    socket              = None
+    meta                = None
+    exit_on_error       = True
+    label               = None      ## what its metrics are labelled with, when that can't wait for a hostname
+    prepared            = None
+    lock_sql            = None
+    killer              = None
+    history             = None
+    connected_once      = False
+    failures            = 0         ## failed connects in a row
+    retry_at            = 0
+    last_used           = 0
+    reconnects          = 0
+    disconnected_at     = None
+    time_disconnected   = 0.0
+
+    def __init__(self, host=None, port=None, config_file=None):
         ## default everything, and override as necessary.
+        self.host = host or args.host
+        self.port = port or args.port
+        self.meta = metadata_cache()
         self.connect_args = {
             'db':           'information_schema',
             'charset':      args.charset,
             'cursorclass':  pymysql.cursors.DictCursor,
-            'host':         args.host,
-            'port':         args.port,
+            'client_flag':  CLIENT.MULTI_STATEMENTS,
+            'host':         self.host,
+            'port':         self.port,
             'user':         args.user,
             'passwd':       args.passwd
         }
 
-        if args.connect_config:
-            self.__load_from_config()
+        if config_file is None and args.connect_config:
+            config_file = os.path.join(MYPSL_CONFIGS, args.connect_config)
+
+        if config_file:
+            self.__load_from_config(config_file)
         else:
-            if args.host == 'localhost':
-                socket = get_mysql_default('socket')
-                if socket:
-                    self.connect_args['unix_socket'] = socket
-                    del self.connect_args['host']
-                    del self.connect_args['port']
-                else:
+            if self.host == 'localhost':
+                self.socket = get_mysql_default('socket')
+                if not self.socket:
                     print(color_val("Unable to use the socket file, will resort to host/port", Fore.RED + Style.BRIGHT), file=sys.stderr)
 
         pymysql.paramstyle = 'pyformat'
 
+    def resolve(self):
+        '''
+            Socket or host/port, worked out again for every connect. A restarted server may not have
+            put its socket back yet, so we use host/port until it has.
+            Host names get looked up again by every connect too, so a DNS name that moved is followed.
+        '''
+        if not self.socket:
+            return
+        if os.path.exists(self.socket):
+            self.connect_args['unix_socket'] = self.socket
+            self.connect_args.pop('host', None)
+            self.connect_args.pop('port', None)
+        else:
+            self.connect_args.pop('unix_socket', None)
+            self.connect_args['host'] = self.host
+            self.connect_args['port'] = self.port
+
     def connect(self):
-        try:
-            self.conn = pymysql.connect(**self.connect_args)
-        except pymysql.Error as e:
+        ## a new session has no prepared statements, and the old cursor belongs to the old connection.
+        self.cursor     = None
+        self.prepared   = None
+        self.resolve()
+        start           = time.time()
+        self.conn       = pymysql.connect(**self.connect_args)
+        now             = time.time()
+        TIMINGS.add('connect', now - start)
+
+        if self.disconnected_at is not None and self.connected_once:
+            self.reconnects         += 1
+            self.time_disconnected  += now - self.disconnected_at
+            print(color_val("{0} :: ({1}) :: Reconnected after {2}s".format(get_now_date(), self.host,
+                round(now - self.disconnected_at, 3)), Fore.GREEN), file=sys.stderr)
+        self.connected_once     = True
+        self.disconnected_at    = None
+        self.failures           = 0
+        self.retry_at           = 0
+        self.last_used          = now
+
+    def ensure(self):
+        '''
+            Connects if we aren't connected, waiting out the backoff from any earlier failures first.
+            Connections that mustn't hold anything else up (exit_on_error is off) raise instead of waiting.
+        '''
+        while not self.conn:
+            wait = self.retry_at - time.time()
+            if wait > 0:
+                if not self.exit_on_error:
+                    raise pymysql.OperationalError(CR.CR_CONN_HOST_ERROR, "Not connected, next attempt in {0}s".format(round(wait, 1)))
+                time.sleep(wait)
+            try:
+                self.connect()
+            except pymysql.Error as e:
+                self.failed(e)
+
+    def failed(self, e):
+        self.failures += 1
+        if self.disconnected_at is None:
+            self.disconnected_at = time.time()
+
+        ## never having connected at all is a configuration problem, not something to wait out.
+        if self.exit_on_error and (not self.connected_once or (args.loop_second_interval <= 0 and self.failures >= RECONNECT_ATTEMPTS)):
             print(color_val("MySQL Said: {0}: {1}".format(e.args[0],e.args[1]), Fore.RED + Style.BRIGHT))
 
             msg = "ERROR: Unable to connect to mysql"
@@ -158,29 +379,140 @@ class mydb():
             print(color_val(msg, Fore.RED + Style.BRIGHT))
             sys.exit(1)
 
-    def query(self, sql, args=[]):
+        wait            = random.uniform(0.5, 1) * min(RECONNECT_BACKOFF_BASE * 2 ** self.failures, RECONNECT_BACKOFF_MAX)
+        self.retry_at   = time.time() + wait
+        print(color_val("{0} :: ({1}) :: {2}, retrying in {3}s".format(get_now_date(), self.host, e.args[-1], round(wait, 1)),
+            Fore.RED + Style.BRIGHT), file=sys.stderr)
+        if not self.exit_on_error:
+            ## watching several hosts, one being down shouldn't take the others with it.
+            raise e
+
+    def lost(self):
+        ## the session's gone, and everything tied to it with it.
+        self.conn       = None
+        self.cursor     = None
+        self.prepared   = None
+        if self.disconnected_at is None:
+            self.disconnected_at = time.time()
+
+    def keepalive(self):
+        '''
+            A ping for a connection that has sat idle for KEEPALIVE_INTERVAL, so a long loop interval doesn't
+            run into wait_timeout, and a dead server is found (and reconnected to) while we're waiting anyway.
+        '''
+        if not self.conn or time.time() - self.last_used < KEEPALIVE_INTERVAL:
+            return
         try:
-            if not self.cursor:
-                self.cursor = self.conn.cursor()
-            if args:
-                self.cursor.execute(sql, args)
-            else:
-                self.cursor.execute(sql)
-
-        except (AttributeError, pymysql.OperationalError):
-            self.connect()
-            self.query(sql, args)
+            self.conn.ping(reconnect=False)
+            self.last_used = time.time()
+        except pymysql.Error:
+            self.lost()
+            try:
+                self.ensure()
+            except pymysql.Error:
+                pass
 
-        if self.cursor:
-            return self.cursor
-        return False
+    def connections(self):
+        ## this one plus the kill pool's, everything that wants keeping alive
+        return [self] + (self.killer.conns[1:] if self.killer else [])
 
-    def __load_from_config(self):
-        cfile = os.path.join(MYPSL_CONFIGS, args.connect_config)
+    def query(self, sql, args=[], reconnect=True, unbuffered=False):
+        self.ensure()
+        try:
+            if unbuffered:
+                ## rows are read off the wire as they're iterated, rather than all held in memory first.
+                ## needs its own cursor, which has to be read to the end before anything else can use the connection.
+                cur = self.conn.cursor(pymysql.cursors.SSDictCursor)
+            else:
+                if not self.cursor:
+                    self.cursor = self.conn.cursor()
+                cur = self.cursor
+            ## every execute is one round trip to the server, which --debug reports per tick.
+            self.num_queries += 1
+            if args:
+                cur.execute(sql, args)
+            else:
+                cur.execute(sql)
+
+        except (pymysql.OperationalError, pymysql.InterfaceError) as e:
+            if not connection_lost(e):
+                raise
+            self.lost()
+            if not reconnect:
+                raise
+            ## once. If it's gone again straight away, that's for the caller.
+            return self.query(sql, args, False, unbuffered)
+
+        self.last_used = time.time()
+        return cur
+
+    def clone(self):
+        ## another connection to the same server, not connected until it's first used.
+        other               = copy.copy(self)
+        other.conn          = None
+        other.cursor        = None
+        other.prepared      = None
+        other.killer        = None
+        other.history       = None
+        other.num_queries   = 0
+        other.exit_on_error = False
+        other.connect_args  = dict(self.connect_args)
+        other.failures      = other.retry_at = other.reconnects = 0
+        other.disconnected_at   = None
+        other.time_disconnected = 0.0
+        return other
+
+    def get_history(self):
+        if not self.history:
+            self.history = process_history(args.history)
+        return self.history
+
+    def kill_engine(self):
+        if not self.killer:
+            self.killer = kill_engine(self, args.kill_concurrency, args.kill_rate, args.kill_query)
+        return self.killer
+
+    def prepare(self, query):
+        '''
+            Prepares the process list query on the server once per session, binding its parameters to
+            session variables. Returns the EXECUTE statement, which is all we need to send each tick after that.
+        '''
+        names = ['@mypsl_{0}'.format(i) for i in range(len(query.params))]
+
+        if self.prepared != query.sql:
+            sql     = "PREPARE {0} FROM %s".format(PREPARED_NAME)
+            params  = [query.prepare_sql]
+            if names:
+                sql     = "SET {0};\n{1}".format(', '.join("{0} = %s".format(n) for n in names), sql)
+                params  = list(query.params) + params
+            cur = self.query(sql, params)
+            while cur.nextset():
+                pass
+            self.prepared = query.sql
+
+        if names:
+            return "EXECUTE {0} USING {1}".format(PREPARED_NAME, ', '.join(names))
+        return "EXECUTE {0}".format(PREPARED_NAME)
+
+    def probe(self, sql):
+        '''
+            Like query, but for asking the server whether something is there.
+            Any error just means "no" rather than a reconnect, so returns None on failure.
+        '''
+        self.ensure()
+        try:
+            self.num_queries += 1
+            cur = self.conn.cursor()
+            cur.execute(sql)
+            return cur.fetchall()
+        except pymysql.Error:
+            return None
+
+    def __load_from_config(self, cfile):
         if os.path.isfile(cfile):
             with open(cfile, 'r') as f:
-                self.connect_args.update(yaml.load(f))
-                args.host = self.connect_args['host']
+                self.connect_args.update(yaml.safe_load(f))
+                self.host = self.connect_args['host']
                 return True
         return False
 
@@ -192,29 +524,237 @@ class mydb():
         if self.conn:
             self.conn.close()
 
-def get_mysql_default(search_opt):
-    my_print_defaults   = find_executable('my_print_defaults')
-    my_cnf_file         = find_my_cnf()
+class process_source():
+    '''
+        Where the process list comes from. Every source returns rows with the same keys
+        (id, user, host, db, command, time, state, info) so process_row() and killah() don't care which one is in use.
+    '''
+    name        = None
+    table       = None
+    columns     = {}
+    where       = []
+
+    def __init__(self, name, table, columns=None, where=None):
+        self.name       = name
+        self.table      = table
+        self.columns    = columns or {}
+        self.where      = where or []
+
+    def col(self, field):
+        ## column aliases can't be used in a WHERE clause, so filters need the real expression.
+        return self.columns.get(field, field)
+
+    def expr(self, template):
+        ## fills in {command}, {info}...etc with this source's columns
+        return template.format(**dict((f, self.col(f)) for f in PROCESS_FIELDS))
+
+    def select_sql(self, fields, computed=()):
+        select = []
+        for f in fields:
+            expr = self.col(f)
+            select.append(f if expr == f else "{0} AS {1}".format(expr, f))
+        for (alias, template) in computed:
+            select.append("{0} AS {1}".format(self.expr(template), alias))
+        return "SELECT SQL_NO_CACHE {0} FROM {1}".format(', '.join(select), self.table)
+
+## in order of preference when auto detecting. information_schema.processlist is always there,
+## but holds a global mutex for the whole scan. The performance_schema doesn't block new connections.
+PROCESS_SOURCES = (
+    process_source('performance_schema', 'performance_schema.threads', {
+        'id':       'PROCESSLIST_ID',
+        ## information_schema shows replication and other internal threads as the 'system user' with no host
+        'user':     "IFNULL(PROCESSLIST_USER, 'system user')",
+        'host':     "IFNULL(PROCESSLIST_HOST, '')",
+        'db':       'PROCESSLIST_DB',
+        'command':  'PROCESSLIST_COMMAND',
+        'time':     'PROCESSLIST_TIME',
+        'state':    'PROCESSLIST_STATE',
+        'info':     'PROCESSLIST_INFO',
+    }, ["TYPE = 'FOREGROUND'", "PROCESSLIST_ID IS NOT NULL"]),
+    process_source('sys', 'sys.`x$processlist`', {
+        'id':       'conn_id',
+        'user':     "SUBSTRING_INDEX(user, '@', 1)",
+        'host':     "SUBSTRING_INDEX(user, '@', -1)",
+        'info':     'current_statement',
+    }, ["conn_id IS NOT NULL"]),
+    process_source('information_schema', 'information_schema.processlist'),
+)
+
+SOURCE_PROBE_SQL = """SELECT @@global.performance_schema AS performance_schema,
+    (SELECT GROUP_CONCAT(CONCAT(table_schema, '.', table_name)) FROM information_schema.tables
+        WHERE (table_schema, table_name) IN {0}) AS tables""".format(
+    "({0})".format(', '.join("('{0}', '{1}')".format(*s.table.replace('`', '').split('.')) for s in PROCESS_SOURCES if s.name != 'information_schema')))
+
+def get_process_source(name='auto', conn=None):
+    conn    = conn or db
+    sources = dict((s.name, s) for s in PROCESS_SOURCES)
+    if name != 'auto':
+        return sources[name]
+
+    ## the performance_schema tables are still there when it's disabled, they're just empty.
+    ## One round trip for all of it: information_schema only lists the tables we're allowed to read.
+    res = conn.probe(SOURCE_PROBE_SQL)
+    if res and int(res[0]['performance_schema']):
+        found = set((res[0]['tables'] or '').split(','))
+        for s in PROCESS_SOURCES:
+            if s.name == 'information_schema':
+                break
+            if s.table.replace('`', '') in found:
+                return s
+    return sources['information_schema']
+
+class where_builder():
+    '''
+        Collects the WHERE conditions for a process source. Fields are written as {command}, {state}...etc
+        and resolved to the source's columns. Values supplied by the user are always passed as %s
+        parameters, never formatted into the sql.
+    '''
+    source  = None
+    clauses = []
+    params  = []
+
+    def __init__(self, source):
+        self.source     = source
+        self.clauses    = []
+        self.params     = []
+
+    def add(self, clause, *params):
+        self.clauses.append(self.source.expr(clause))
+        self.params.extend(params)
+        return self
+
+    def any_of(self, field, values):
+        ## a single value is a plain comparison, several is an IN list
+        if len(values) == 1:
+            return self.add("{{{0}}} = %s".format(field), values[0])
+        return self.add("{{{0}}} IN ({1})".format(field, ', '.join(['%s'] * len(values))), *values)
+
+    def sql(self):
+        return ' AND '.join(self.clauses)
+
+    def display(self):
+        ## for printing only. What is sent to the server keeps the parameters separate.
+        return self.sql() % tuple("'{0}'".format(p) for p in self.params)
+
+class process_query():
+    '''
+        The process list statement with its parameters kept separate from the sql.
+    '''
+    sql     = None
+    params  = ()
+    source  = None
+
+    def __init__(self, sql, params=(), source=None):
+        self.sql    = sql
+        self.params = tuple(params)
+        self.source = source
+
+    @property
+    def prepare_sql(self):
+        ## PREPARE wants ? placeholders rather than the %s that pymysql uses
+        return self.sql.replace('%s', '?')
+
+def get_mysql_default(search_opt, groups=('mysqld', 'client')):
+    '''
+        An option from the my.cnf, what my_print_defaults would have told us without forking it.
+        The socket is looked up on every localhost connect, so it's cached, good for as long as none of the files it came from change.
+    '''
+    my_cnf_file = find_my_cnf()
+    if not my_cnf_file:
+        return None
 
-    if not my_cnf_file:         return None
-    if not my_print_defaults:   return None
+    cache   = read_defaults_cache()
+    key     = "{0}:{1}:{2}".format(my_cnf_file, ','.join(groups), search_opt)
+    hit     = cache.get(key)
+    if hit and all(file_mtime(f) == m for (f, m) in hit['files']):
+        return hit['value']
+
+    files   = []
+    options = read_my_cnf(my_cnf_file, files)
+    value   = None
+    for g in groups:
+        if search_opt in options.get(g, {}):
+            value = options[g][search_opt]
+            break
+
+    cache[key] = {'value': value, 'files': [(f, file_mtime(f)) for f in files]}
+    write_defaults_cache(cache)
+    return value
+
+def read_my_cnf(path, files, options=None):
+    '''
+        Reads a my.cnf into {group: {option: value}}, following !include and !includedir the way the
+        server does. Later settings win, and option names are stored with _ rather than -.
+        files collects every file that was read, or looked for, and every !includedir directory,
+        so a file turning up later changes an mtime the cache is keyed on.
+    '''
+    options = {} if options is None else options
+    if path in files:
+        return options
+    files.append(path)
+    if not os.path.isfile(path):
+        return options
+
+    group = None
+    try:
+        with open(path, 'r') as f:
+            lines = f.readlines()
+    except IOError:
+        return options
+
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] in '#;':
+            continue
+        if line.startswith('!includedir'):
+            d = line[len('!includedir'):].strip()
+            files.append(d)
+            for inc in sorted(glob.glob(os.path.join(d, '*.cnf'))):
+                read_my_cnf(inc, files, options)
+            continue
+        if line.startswith('!include'):
+            read_my_cnf(line[len('!include'):].strip(), files, options)
+            continue
+        if line.startswith('['):
+            group = line[1:line.find(']')].strip().lower()
+            continue
+        if group is None:
+            continue
 
-    cmd     = [my_print_defaults, '--defaults-file', my_cnf_file, 'mysqld']
-    proc    = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    proc.wait()
+        (opt, _, val) = line.partition('=')
+        val = val.strip()
+        if val[:1] in ('"', "'") and val[-1:] == val[:1] and len(val) > 1:
+            val = val[1:-1]
+        else:
+            ## comments can follow the value too
+            val = re.split(r'\s#', val, 1)[0].strip()
+        options.setdefault(group, {})[opt.strip().replace('-', '_')] = val
+    return options
 
-    if proc.returncode != 0:
-        print(color_val(proc.stderr.readlines(), Fore.RED + Style.BRIGHT), file=sys.stderr)
+def file_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
         return None
-    defaults = proc.stdout.readlines()
 
-    if not defaults:
-        return None
+def read_defaults_cache():
+    try:
+        with open(DEFAULTS_CACHE, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
 
-    for d in defaults:
-        if d.startswith("--{0}".format(search_opt)):
-            return d.split('=')[1].strip()
-    return None
+def write_defaults_cache(cache):
+    ## a cache, so not being able to write it just means working it out again next time
+    try:
+        if not os.path.isdir(os.path.dirname(DEFAULTS_CACHE)):
+            os.makedirs(os.path.dirname(DEFAULTS_CACHE))
+        tmp = "{0}.{1}".format(DEFAULTS_CACHE, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(cache, f)
+        os.rename(tmp, DEFAULTS_CACHE)
+    except (IOError, OSError):
+        pass
 
 def find_my_cnf():
     ## why oh why do different flavors of linux have to put these in different places.
@@ -244,6 +784,7 @@ def parse_args():
     con_opt_group   = parser.add_argument_group(color_val('Connection Options', Fore.YELLOW + Style.BRIGHT))
     config_group    = parser.add_argument_group(color_val('Configuration Options', Fore.YELLOW + Style.BRIGHT))
     kill_group      = parser.add_argument_group(color_val('Kill Options', Fore.RED + Style.BRIGHT))
+    repl_group      = parser.add_argument_group(color_val('Replication Options', Fore.YELLOW + Style.BRIGHT))
 
     con_opt_group.add_argument('-H', '--host', dest='host', type=str, default='localhost',
         help='The host to get the process list from. If localhost, we will attempt to find and use the socket file first.')
@@ -260,25 +801,52 @@ def parse_args():
     con_opt_group.add_argument('--config', dest='connect_config', type=str, default=False,
         help='Load connection configuration from a file in {0}. Just provide the filename. '.format(MYPSL_CONFIGS) + \
         'This will override any other connection information provided').completer = _get_config_files
+    con_opt_group.add_argument('--hosts', dest='hosts', type=str,
+        help='Watch several hosts at once: a comma separated list of host[:port]. The user/pass options apply to all of them.')
+    con_opt_group.add_argument('--config_dir', dest='config_dir', type=str, nargs='?', const=MYPSL_CONFIGS,
+        help='Watch every host that has a config file in this directory, {0} if no directory is given.'.format(MYPSL_CONFIGS))
 
     ## ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     config_group.add_argument('-l', '--loop', dest='loop_second_interval', type=int, default=0,
         help='Time in seconds between getting the process list.')
+    config_group.add_argument('--loop_min', dest='loop_min', type=float, metavar='SECONDS',
+        help='When looping, tighten the interval to this as soon as processes or sleepers reach their warning levels ' + \
+        '({0} and {1}).'.format(PROCESS_THRESHOLD_WARN, SLEEPER_THRESHOLD_WARN))
+    config_group.add_argument('--loop_max', dest='loop_max', type=float, metavar='SECONDS',
+        help='When looping, back off towards this while things are quiet (nothing found, or under the warning levels).')
     config_group.add_argument('-dft', '--default', dest='default', action='store_true',
         help='Run with defaults. Loop internal: 3 seconds, command like query or connect, order by time asc, id asc, truncate query to 1000.')
-    config_group.add_argument('-c', '--command', dest='command', type=str,
-        help='Lookup processes running as this command.')
-    config_group.add_argument('-s', '--state', dest='state', type=str,
-        help='Lookup processes running in this state.')
+    config_group.add_argument('-c', '--command', dest='command', type=str, action='append',
+        help='Lookup processes running as this command. Can be given more than once.')
+    config_group.add_argument('-s', '--state', dest='state', type=str, action='append',
+        help='Lookup processes running in this state. Can be given more than once.')
     config_group.add_argument('-t', '--time', dest='time', type=int,
         help='Lookup processes running longer than the specified time in seconds.')
-    config_group.add_argument('-d', '--database', dest='database', type=str,
-        help='Lookup processes running against this database.')
+    config_group.add_argument('-mt', '--max_time', dest='max_time', type=int,
+        help='Lookup processes running no longer than the specified time in seconds.')
+    config_group.add_argument('-d', '--database', dest='database', type=str, action='append',
+        help='Lookup processes running against this database. Can be given more than once.')
     config_group.add_argument('-q', '--query', dest='query', type=str,
         help='Lookup processes where the query starts with this specification.')
+    config_group.add_argument('-qr', '--query_regex', dest='query_regex', type=str,
+        help='Lookup processes where the query matches this (server side) regular expression.')
+    config_group.add_argument('-mu', '--match_user', dest='match_user', type=str, action='append',
+        help='Lookup processes connected as this user. Can be given more than once.')
+    config_group.add_argument('-mh', '--match_host', dest='match_host', type=str,
+        help='Lookup processes connected from a host starting with this.')
     config_group.add_argument('-i', '--id', dest='id_only', action='store_true',
         help='Only print back the ID of the processes.')
+    config_group.add_argument('-f', '--format', dest='format', type=str, default='text', choices=['text', 'jsonl', 'csv', 'tsv', 'tui', 'prometheus'],
+        help='Output format. jsonl, csv and tsv write one record per process plus one summary record per tick, for piping into other tools. ' +
+            'tui is a full screen live view that only redraws what changed, sortable by column. ' +
+            'prometheus serves the stats, per user, per fingerprint and per host, on /metrics (see --metrics_listen). ' +
+            'Both loop every 3 seconds unless --loop says otherwise.')
+    config_group.add_argument('--timings', dest='timings', action='store_true',
+        help='Print how long each stage of a tick took (connect, query, fetch, process, render, kill, log) and the rows and bytes fetched. ' +
+            'Rolling p50/p95/max are printed to stderr on SIGUSR1, with or without this.')
+    config_group.add_argument('--metrics_listen', dest='metrics_listen', type=str, default='127.0.0.1:9797', metavar='[ADDR:]PORT',
+        help='Where --format prometheus serves /metrics. Default: %(default)s')
     config_group.add_argument('-isr', '--ignore_system_user', dest='ignore_system_user', action='store_true',
         help="Ignore the 'system user'")
     config_group.add_argument('--debug', dest='debug', action='store_true',
@@ -286,7 +854,43 @@ def parse_args():
     config_group.add_argument('-o', '--order_by', dest='order_by', type=str,
         help='Order the results by a particular column: "user", "db asc", "db desc", "time desc"...etc')
     config_group.add_argument('-T', '--trim_info', dest='trim_info', action='store_true',
-        help='Trim the info field (the query) to {0}'.format(INFO_TRIM_LENGTH))
+        help='Trim the info field (the query) to {0}. The server does the trimming, so the rest is never sent.'.format(INFO_TRIM_LENGTH))
+    config_group.add_argument('--history', dest='history', type=int, default=0,
+        help='Remember this many ticks when looping, to show new/finished threads per tick and how fast each stat is growing. 0 is off.')
+    config_group.add_argument('--top', dest='top', type=int, default=5,
+        help='With --history, show this many of the longest running threads. With --locks, this many of the root blockers.')
+    config_group.add_argument('--locks', dest='locks', action='store_true',
+        help='Work out who is waiting on whom for row and metadata locks each tick, and show the root blockers ' + \
+        '(blocking others, waiting on no one) and how many are stuck behind each above the process list.')
+    config_group.add_argument('-fp', '--fingerprints', dest='fingerprints', type=int, default=0,
+        help='Show this many of the statement shapes (literals stripped) holding the most connections, with their total and max time. 0 is off. ' + \
+        'Only the first {0} characters of a statement are used, with or without -T, so the ids match --kill_fingerprint.'.format(INFO_TRIM_LENGTH))
+    config_group.add_argument('--stats', dest='stats', action='store_true',
+        help='Only show the stats and users lines. The server counts them up by user, so only a few numbers come back ' + \
+        'each tick instead of every process and its query. Cheap enough to loop every second across a fleet.')
+    config_group.add_argument('--stream', dest='stream', action='store_true',
+        help='Read the process list one row at a time instead of all at once, so memory stays flat with thousands of ' + \
+        'connections carrying large queries. Kills go out once the whole list has been read, over the --kill_concurrency connections, ' + \
+        'the one the list came from included.')
+    config_group.add_argument('--record', dest='record', type=str, metavar='FILE',
+        help='Append every snapshot to FILE (and an index to FILE.idx), compressed, to look back at with --replay.')
+    config_group.add_argument('--replay', dest='replay', type=str, metavar='FILE',
+        help='Show the snapshots recorded in FILE instead of asking a server. Filters were applied when recording, so they do nothing here.')
+    config_group.add_argument('--replay_speed', dest='replay_speed', type=float, default=1,
+        help='How much faster than recorded to replay. 0 is as fast as possible.')
+    config_group.add_argument('--replay_from', dest='replay_from', type=parse_replay_time, metavar='"YYYY-mm-dd HH:MM:SS"',
+        help='Start the replay at the first snapshot from this time.')
+    config_group.add_argument('--replay_to', dest='replay_to', type=parse_replay_time, metavar='"YYYY-mm-dd HH:MM:SS"',
+        help='Stop the replay after this time.')
+    config_group.add_argument('--agent', dest='agent', type=str, metavar='SOCKET',
+        help='Poll the server every --loop seconds (3 by default) and send each snapshot to the --attach clients on this unix socket, ' + \
+        'so the server is polled once however many are watching. Filters given here apply to everyone, so usually give none.')
+    config_group.add_argument('--attach', dest='attach', type=str, metavar='SOCKET',
+        help="Show the snapshots from an --agent on this socket instead of polling the server. The filter and order options are applied here.")
+    config_group.add_argument('--source', dest='source', type=str, default='auto',
+        choices=['auto'] + [s.name for s in PROCESS_SOURCES],
+        help='Where to read the process list from. auto prefers performance_schema.threads when it is enabled, ' + \
+        'since information_schema.processlist blocks new connections while it is read.')
 
     ## ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -299,8 +903,51 @@ def parse_args():
         help="If this flag is provided, we'll attempt to kill everything, not only select queries. {0}".format(color_val("Use with caution!", Fore.RED + Style.BRIGHT))) 
     kill_group.add_argument('-ky', '--kill_yes', dest='kill_yes', action='store_true',
         help="If this is provided we won't stop to ask if you are sure that you want to kill queries.")
+    kill_group.add_argument('-kf', '--kill_fingerprint', dest='kill_fingerprint', type=str,
+        help="Only kill queries with this fingerprint, either the id shown by --fingerprints or the fingerprint itself.")
+    kill_group.add_argument('--kill_policy', dest='kill_policy', type=str, metavar='FILE',
+        help="Kill by the rules in this YAML file instead of the select-only/--kill_all/--kill_fingerprint checks: a list of rules, " + \
+        "each with a name, any of user, host (prefix), db, command, state, keyword, query (regex), fingerprint, min_time and max_time, " + \
+        "and its own threshold (default --kill_threshold) and max_kills per tick. A process goes to the first rule it matches.")
+    kill_group.add_argument('--kill_dry_run', dest='kill_dry_run', action='store_true',
+        help="With --kill_policy, kill nothing: show what each rule would kill each tick and how long its matching took.")
+    kill_group.add_argument('--kill_roots', dest='kill_roots', type=int, default=0, metavar='N',
+        help="Only kill the root blockers of lock waits (see --locks) with at least N waiting behind them, whatever they're running. " + \
+        "The other criteria aren't needed, a pile-up is cleared with one KILL instead of one per waiting query.")
+    kill_group.add_argument('-kq', '--kill_query', dest='kill_query', action='store_true',
+        help="Use KILL QUERY, which stops the running statement but leaves the connection alone.")
+    kill_group.add_argument('-kc', '--kill_concurrency', dest='kill_concurrency', type=int, default=4,
+        help="How many connections to send KILLs out on at once.")
+    kill_group.add_argument('-kr', '--kill_rate', dest='kill_rate', type=float, default=0,
+        help="The most kills to send per second. 0 doesn't limit the rate.")
     kill_group.add_argument('-kl', '--kill_log', dest='kill_log', default='/var/log/killed_queries.log',
         help="Where to log killed queries to, granting permissions to write to this file.")
+    kill_group.add_argument('-klf', '--kill_log_format', dest='kill_log_format', default='text', choices=['text', 'json'],
+        help="text keeps the original 'k: v, k: v' lines, json writes one JSON object per kill with the full row and the kill latency.")
+    kill_group.add_argument('--kill_log_fsync', dest='kill_log_fsync', type=float, default=1.0,
+        help="Seconds between syncing the kill log to disk.")
+    kill_group.add_argument('--kill_log_max_size', dest='kill_log_max_size', type=float, default=100,
+        help="Rotate the kill log once it reaches this many MB. 0 never rotates.")
+    kill_group.add_argument('--kill_log_backups', dest='kill_log_backups', type=int, default=5,
+        help="How many rotated kill logs to keep.")
+
+    ## ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    repl_group.add_argument('--replication', dest='replication', type=float, nargs='?', const=0.5, metavar='SECONDS',
+        help='Watch replication instead of the process list, checking every SECONDS (0.5 if not given, 0 checks once). ' + \
+        'Every channel of every host given (see --hosts and --config_dir) is checked at once, and alerts go to stdout and --repl_email.')
+    repl_group.add_argument('--repl_lag', dest='repl_lag', type=int, default=1000,
+        help='Alert when a replica has been at least this many seconds behind for all of --repl_window.')
+    repl_group.add_argument('--repl_window', dest='repl_window', type=float, default=60,
+        help='Seconds the lag has to last before it is alerted on, and of samples kept for the min/avg/max.')
+    repl_group.add_argument('--repl_realert', dest='repl_realert', type=float, default=3600,
+        help='Seconds before an alert that is still going on is sent again. Every alert is sent once more when it clears.')
+    repl_group.add_argument('--repl_report', dest='repl_report', type=float, default=10,
+        help='Seconds between printing the state of every replica.')
+    repl_group.add_argument('--repl_email', dest='repl_email', type=str,
+        help='Also email alerts here, with mail -t.')
+    repl_group.add_argument('--repl_deployment', dest='repl_deployment', type=str, default='UNSPECIFIED',
+        help='Goes at the start of the alert subjects, to tell deployments apart.')
 
     if HAS_ARGCOMPLETE:
         argcomplete.autocomplete(parser)
@@ -309,12 +956,13 @@ def parse_args():
 def myp(d):
     print(json.dumps(d, indent=4))
 
-def get_now_date():
-    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+def get_now_date(when=None):
+    ## when, so a replayed snapshot shows the time it was recorded
+    return (datetime.datetime.fromtimestamp(when) if when else datetime.datetime.now()).strftime("%Y-%m-%d %H:%M:%S")
 
-def print_header():
-    ct = get_connected_threads()
-    mc = get_max_connections()
+def print_header(snap, blockers=True):
+    ct = snap.connected_threads
+    mc = snap.max_connections
 
     if (ct > (mc * .75)):
         ct_str = color_val(ct, Fore.RED)
@@ -325,10 +973,13 @@ def print_header():
 
     bar = "-"*35
     header = "%s%s%s %s%s :: %s :: Threads (%s / %s) %s%s%s" % \
-        (Fore.YELLOW, bar, Fore.GREEN, get_hostname(), Fore.RESET, get_now_date(), ct_str, mc, Fore.YELLOW, bar, Fore.RESET)
+        (Fore.YELLOW, bar, Fore.GREEN, snap.host, Fore.RESET, get_now_date(snap.taken), ct_str, mc, Fore.YELLOW, bar, Fore.RESET)
 
     print(header)
-    print("{0}".format(Style.BRIGHT) + OUT_FORMAT.format("ID", "USER", "HOST", "DB", "COMMAND", "TIME", "STATE", "INFO") + "{0}".format(Style.RESET_ALL))
+    if snap.locks and blockers:
+        print_blockers(snap.locks)
+    if not args.stats:
+        print("{0}".format(Style.BRIGHT) + OUT_FORMAT.format(*OUT_TITLES) + "{0}".format(Style.RESET_ALL))
 
 def sig_handler(signal, frame):
     if db:
@@ -340,99 +991,1365 @@ def sig_handler(signal, frame):
     print()
     sys.exit(0)
 
-def get_long_query_time():
-    sql = "SHOW GLOBAL VARIABLES LIKE 'long_query_time'"
-    cur = db.query(sql)
-    res = cur.fetchone()
-    if res and 'Value' in res:
-        return int(round(float(res['Value'])))
-    return 0
-
-def get_connected_threads():
-    sql = "SHOW GLOBAL STATUS LIKE 'Threads_connected'"
-    cur = db.query(sql)
-    res = cur.fetchone()
-    if res and 'Value' in res:
-        return int(res['Value'])
-    return 0
-
-def get_max_connections():
-    sql = "SHOW GLOBAL VARIABLES LIKE 'max_connections'"
-    cur = db.query(sql)
-    res = cur.fetchone()
-    if res and 'Value' in res:
-        return int(res['Value'])
-    return 0
-
-def get_num_sleepers():
-    sql = "SELECT SQL_NO_CACHE count(id) AS num_sleepers FROM processlist WHERE command = 'Sleep' OR state = 'User sleep'"
-    cur = db.query(sql)
-    res = cur.fetchone()
-    if res and 'num_sleepers' in res:
-        return int(res['num_sleepers'])
-    return 0
-
-def get_hostname():
-    global HOSTNAME
-
-    if HOSTNAME: return HOSTNAME
-
-    if args.host == 'localhost':
-        ## local, just use socket.gethostname
-        HOSTNAME = gethostname()
-    else:
-        ## we're going to ask the remote mysql server
-        sql = "SELECT @@hostname AS hostname"
-        cur = db.query(sql)
+class metadata_cache():
+    '''
+        Server values that rarely change, each kept until its ttl runs out.
+        A SIGUSR2 bumps METADATA_GENERATION, which expires everything so changes are picked up on the next tick.
+    '''
+    values      = {}
+    expires     = {}
+    generation  = 0
+
+    def __init__(self):
+        self.values     = {}
+        self.expires    = {}
+        self.generation = METADATA_GENERATION
+
+    def stale(self, keys=None):
+        if self.generation != METADATA_GENERATION:
+            self.expires    = {}
+            self.generation = METADATA_GENERATION
+        now = time.time()
+        return [k for (k, expr, ttl) in METADATA if (keys is None or k in keys) and self.expires.get(k, 0) <= now]
+
+    def update(self, values):
+        now = time.time()
+        ttl = dict((k, ttl) for (k, expr, ttl) in METADATA)
+        for (k, v) in values.items():
+            self.values[k]  = v
+            self.expires[k] = now + ttl.get(k, 60)
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def variables_sql(self, keys):
+        return "SELECT {0}".format(', '.join("{0} AS {1}".format(expr, k) for (k, expr, ttl) in METADATA if k in keys))
+
+    @property
+    def flavor(self):
+        version = "{0} {1}".format(self.get('version', ''), self.get('version_comment', '')).lower()
+        if 'mariadb' in version:    return 'MariaDB'
+        if 'percona' in version:    return 'Percona Server'
+        return 'MySQL'
+
+def refresh_metadata(signal, frame):
+    ## kill -USR2 <pid> to pick up changed server variables without waiting on their ttl
+    global METADATA_GENERATION
+    METADATA_GENERATION += 1
+
+class snapshot():
+    '''
+        Everything a single tick needs from the server: the process list rows plus the status
+        and variable values used by the header, the stats and the kill threshold.
+        It's fetched in one round trip and then shared, so nothing else should need to query for these.
+
+        When streaming, rows is an iterator that can only be walked once.
+    '''
+    rows        = ()
+    status      = {}
+    variables   = {}
+    host        = None
+    source      = None
+    taken       = 0
+    reconnects  = 0     ## of the connection it came from, so far
+    disconnected = 0.0
+    locks       = None  ## the lock_graph, with --locks
+    label       = None  ## the connection's, the host_watcher's in multi-host mode
+
+    def __init__(self, rows, status, variables, host=None, source=None):
+        self.rows       = rows
+        self.status     = status
+        self.variables  = variables
+        self.host       = host
+        self.source     = source
+        self.taken      = time.time()
+
+    def _int(self, source, key):
+        try:
+            return int(round(float(source.get(key) or 0)))
+        except (TypeError, ValueError):
+            return 0
+
+    @property
+    def connected_threads(self):
+        return self._int(self.status, 'Threads_connected')
+
+    @property
+    def running_threads(self):
+        return self._int(self.status, 'Threads_running')
+
+    @property
+    def max_connections(self):
+        return self._int(self.variables, 'max_connections')
+
+    @property
+    def long_query_time(self):
+        return self._int(self.variables, 'long_query_time')
+
+    @property
+    def num_sleepers(self):
+        ## anything connected but not running is sleeping, no need to scan the process list a second time for these.
+        return max(self.connected_threads - self.running_threads, 0)
+
+def stream_rows(cur, first):
+    try:
+        yield first
+        for row in cur.fetchall_unbuffered():
+            yield row
+    finally:
+        cur.close()
+
+def take_snapshot(query, conn=None, retry=True):
+    conn    = conn or db
+    cur     = None
+    stale   = conn.meta.stale()
+    batch   = [SNAPSHOT_STATUS_SQL]
+
+    if stale:
+        batch.append(conn.meta.variables_sql(stale))
+
+    locks_sql = args.locks and lock_waits_sql(conn, query.source)
+    if locks_sql:
+        batch.append(locks_sql)
+
+    start   = time.time()
+    ## the process list has to be the last result, so when streaming everything else has been read before we get to it.
+    if args.loop_second_interval > 0:
+        ## looping, so the statement lives on the server and only the EXECUTE goes over the wire each tick.
+        try:
+            cur = conn.query(';\n'.join(batch + [conn.prepare(query)]), reconnect=False, unbuffered=args.stream)
+        except pymysql.Error:
+            ## prepared statements go away with the session. Send the whole thing this time, and prepare again next tick.
+            conn.prepared = None
+
+    if not cur:
+        cur = conn.query(';\n'.join(batch + [query.sql]), query.params, unbuffered=args.stream)
+
+    try:
+        status      = dict((r['Variable_name'], r['Value']) for r in cur.fetchall())
+        fetched     = time.time()
+        TIMINGS.add('query', fetched - start)
+        cur.nextset()
+        if stale:
+            conn.meta.update((cur.fetchall() or [{}])[0])
+            cur.nextset()
+        if locks_sql:
+            edges = cur.fetchall()
+            cur.nextset()
+
+        if args.stream:
+            ## peek at the first row so an empty process list still looks empty
+            first   = cur.fetchone()
+            rows    = stream_rows(cur, first) if first else ()
+            if not first:
+                cur.close()
+        else:
+            rows    = cur.fetchall()
+    except (pymysql.OperationalError, pymysql.InterfaceError) as e:
+        if not retry or not connection_lost(e):
+            raise
+        ## went away while we were reading the batch, query() reconnects for the second go.
+        conn.lost()
+        return take_snapshot(query, conn, False)
+    TIMINGS.add('fetch', time.time() - fetched)
+
+    snap                = snapshot(rows, status, dict(conn.meta.values), source=query.source)
+    snap.host           = get_hostname(conn)
+    snap.label          = conn.label
+    snap.reconnects     = conn.reconnects
+    snap.disconnected   = conn.time_disconnected
+    if locks_sql:
+        snap.locks      = lock_graph(edges, conn, query.source)
+    if RECORDER:
+        RECORDER.record(snap)
+    return snap
+
+def lock_waits_sql(conn, source):
+    '''
+        The --locks query for this server, worked out the first time and kept with the connection.
+        Metadata locks need the performance_schema, which the process source being something else says we don't have.
+        It's tried once on its own first: without the privileges for it, it would take the whole snapshot batch down with it,
+        so then --locks is left out for this connection instead.
+    '''
+    if conn.lock_sql is None:
+        version = tuple(int(v) for v in re.findall(r'\d+', get_metadata('version', conn) or '')[:3])
+        parts   = [ROW_LOCK_WAITS_SQL if conn.meta.flavor != 'MariaDB' and version >= (8, 0) else INNODB_LOCK_WAITS_SQL]
+        if source and source.name != 'information_schema':
+            parts.append(METADATA_LOCK_WAITS_SQL)
+        sql = '\nUNION ALL\n'.join(parts)
+        try:
+            conn.query(sql + '\nLIMIT 0').fetchall()
+        except pymysql.Error as e:
+            if connection_lost(e) or not conn.conn:
+                raise
+            print(color_val("{0} :: ({1}) :: Unable to read the lock waits, carrying on without --locks: {2}".format(get_now_date(),
+                conn.host, e), Fore.RED + Style.BRIGHT), file=sys.stderr)
+            sql = ''
+        conn.lock_sql = sql
+    return conn.lock_sql
+
+class lock_graph():
+    '''
+        The wait-for graph for a tick. A root blocker is blocking someone without waiting on anyone itself,
+        so killing it frees everything in its tree, where killing the waiters frees nothing.
+        The roots' own process list rows are fetched separately (describe()), since the filters may have left them out.
+    '''
+    waiters     = {}        ## blocker -> the ids waiting on it directly
+    waiting     = set()
+    kinds       = {}        ## blocker -> set of 'row' and/or 'metadata'
+    roots       = {}        ## root blocker -> how many are waiting on it, directly or not
+    conn        = None
+    source      = None
+    rows        = None
+
+    def __init__(self, edges, conn=None, source=None):
+        self.waiters    = defaultdict(set)
+        self.waiting    = set()
+        self.kinds      = defaultdict(set)
+        self.conn       = conn
+        self.source     = source
+        for e in edges:
+            if e['waiting'] is None or e['blocking'] is None or e['waiting'] == e['blocking']:
+                continue
+            (w, b) = (int(e['waiting']), int(e['blocking']))
+            self.waiters[b].add(w)
+            self.waiting.add(w)
+            self.kinds[b].add(e['kind'])
+        ## a deadlock has no root, InnoDB will sort that out by itself
+        self.roots = dict((b, self.tree_size(b)) for b in self.waiters if b not in self.waiting)
+
+    def tree_size(self, root):
+        seen = set()
+        todo = [root]
+        while todo:
+            for w in self.waiters.get(todo.pop(), ()):
+                if w not in seen:
+                    seen.add(w)
+                    todo.append(w)
+        seen.discard(root)
+        return len(seen)
+
+    def describe(self):
+        ## the roots' rows, biggest tree first. Only once the process list has been read, a stream would still have the connection.
+        if self.rows is None:
+            self.rows = []
+            if self.roots and self.source:
+                ids = sorted(self.roots)
+                sql = "{0} WHERE {1} IN ({2})".format(self.source.select_sql(PROCESS_FIELDS), self.source.col('id'), ', '.join(['%s'] * len(ids)))
+                self.rows = sorted(self.conn.query(sql, ids).fetchall(), key=lambda r: self.roots.get(r['id'], 0), reverse=True)
+        return self.rows
+
+def print_blockers(locks):
+    if not locks.waiting:
+        return
+    print("\t({0}) waiting: {1}, root blockers: {2}".format(color_val("Locks", Fore.GREEN),
+        color_val(len(locks.waiting), Fore.YELLOW), color_val(len(locks.roots), Fore.RED)))
+    for row in locks.describe()[:args.top]:
+        print("\t({0}) {1} {2}@{3} {4} {5}s, {6} waiting on {7} locks: {8}".format(color_val("Blocking", Fore.RED), row['id'],
+            row['user'], (row['host'] or '').split(':')[0], row['command'], color_val(row['time'], Fore.YELLOW),
+            color_val(locks.roots.get(row['id'], 0), Fore.RED), '/'.join(sorted(locks.kinds[row['id']])),
+            (row['info'] or '--')[:HISTORY_INFO_LENGTH]))
+
+def get_metadata(key, conn=None):
+    conn = conn or db
+
+    if conn.meta.stale([key]):
+        ## usually the snapshot has already done this for us. If not, fetch everything that's stale while we're at it.
+        cur = conn.query(conn.meta.variables_sql(conn.meta.stale()))
         res = cur.fetchone()
-        if res and 'hostname' in res:
-            HOSTNAME = res['hostname']
+        if res:
+            conn.meta.update(res)
+
+    return conn.meta.get(key)
+
+def get_hostname(conn=None):
+    conn = conn or db
 
-    return HOSTNAME
+    if conn.host == 'localhost':
+        ## local, just use socket.gethostname
+        return gethostname()
+    ## we're going to ask the remote mysql server
+    return get_metadata('hostname', conn)
+
+class no_color():
+    ## stands in for colorama's Fore and Style when we aren't writing to a terminal
+    def __getattr__(self, name):
+        return ''
+
+if not HAS_COLOR:
+    ## no terminal to color, so don't make the escape codes at all. colorama would only be stripping them back out of every write.
+    Fore = Style = no_color()
 
 def color_val(val, color):
     return "%s%s%s" % (color, val, Style.RESET_ALL)
 
-def record_kill(row):
-    if os.path.exists(args.kill_log):
-        if not os.access(args.kill_log, os.W_OK):
+class kill_logger():
+    '''
+        Writes the kill log from a background thread, so killing never waits on the disk.
+        Records are queued as they happen, written in batches, fsync'd every fsync_interval seconds
+        and the file is rotated once it grows past max_bytes.
+        fmt is 'text' for the original "k: v, k: v" lines or 'json' for one JSON object per line.
+    '''
+    path            = None
+    fmt             = 'text'
+    fsync_interval  = 1.0
+    max_bytes       = 0
+    backups         = 5
+    batch_size      = 500
+
+    def __init__(self, path, fmt='text', fsync_interval=1.0, max_bytes=0, backups=5):
+        self.path           = path
+        self.fmt            = fmt
+        self.fsync_interval = fsync_interval
+        self.max_bytes      = max_bytes
+        self.backups        = backups
+        self.queue          = Queue()
+        self.fh             = None
+        self.last_sync      = time.time()
+        self.thread         = threading.Thread(target=self._run, name='kill_logger')
+        self.thread.daemon  = True
+
+    def open(self):
+        ## checked once up front rather than on every kill
+        try:
+            self.fh = open(self.path, 'a')
+        except IOError:
+            print(color_val("Unable to write to: {0}, kills will not be logged".format(self.path), Fore.RED + Style.BRIGHT), file=sys.stderr)
+            return False
+        self.thread.start()
+        atexit.register(self.close)
+        return True
+
+    def record(self, row, host, latency=None):
+        self.queue.put((get_now_date(), host, row, latency))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def format(self, record):
+        (date, host, row, latency) = record
+        if self.fmt == 'json':
+            rec = {'date': date, 'host': host, 'row': row}
+            if latency is not None:
+                rec['kill_latency_ms'] = round(latency * 1000, 3)
+            return json.dumps(rec, default=str) + "\n"
+        return "{0} :: {1} :: {2}\n".format(date, host, ', '.join("%s: %s" % (k, v) for (k, v) in row.items()))
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get())
+
+            done    = None in batch
+            start   = time.time()
+            self.fh.write(''.join(self.format(r) for r in batch if r is not None))
+            self.fh.flush()
+
+            if done or time.time() - self.last_sync >= self.fsync_interval:
+                self._sync()
+                self.last_sync = time.time()
+            TIMINGS.add('log', time.time() - start)
+
+            if self.max_bytes and self.fh.tell() >= self.max_bytes:
+                self._rotate()
+
+            if done:
+                self.fh.close()
+                return
+
+    def _sync(self):
+        try:
+            os.fsync(self.fh.fileno())
+        except OSError:
+            ## a pipe or /dev/null, nothing to sync
+            pass
+
+    def _rotate(self):
+        ## killed_queries.log -> killed_queries.log.1 -> killed_queries.log.2 ...etc
+        self._sync()
+        self.fh.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("{0}.{1}".format(self.path, i)):
+                os.rename("{0}.{1}".format(self.path, i), "{0}.{1}".format(self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, "{0}.1".format(self.path))
+        else:
+            os.remove(self.path)
+        self.fh = open(self.path, 'a')
+
+## --record files: a frame is a 4 byte length and a zlib'd JSON snapshot. user/host/db/command/state strings
+## are sent once and then referred to by number. The numbering starts over at every keyframe, so reading
+## can start at any keyframe. The sidecar index has a (time, offset, keyframe offset) record per snapshot.
+RECORD_FIELDS           = PROCESS_FIELDS + ('info_length', 'info_keyword')
+RECORD_INTERNED         = ('user', 'host', 'db', 'command', 'state', 'info_keyword')
+RECORD_INTERNED_AT      = tuple(RECORD_FIELDS.index(f) for f in RECORD_INTERNED)
+RECORD_KEYFRAME_EVERY   = 300       ## snapshots
+RECORD_MAX_STRINGS      = 50000     ## or sooner, if the string table gets this big
+RECORD_FRAME            = struct.Struct('>I')
+RECORD_INDEX            = struct.Struct('>dQQ')
+AGENT_BACKLOG           = 16
+ATTACH_POLL             = 0.1       ## seconds between looking for the next snapshot from the agent
+
+def record_rows(rows):
+    return [tuple(r.get(f) for f in RECORD_FIELDS) for r in rows]
+
+def encode_snapshot(snap, rows, table, keyframe):
+    '''
+        A frame's payload, rows being from record_rows(). table is the string numbering so far, and gets the new ones added.
+        A keyframe has to start with an empty table.
+    '''
+    new = []
+    out = []
+    for r in rows:
+        r = list(r)
+        for i in RECORD_INTERNED_AT:
+            if r[i] is not None:
+                n = table.get(r[i])
+                if n is None:
+                    n = table[r[i]] = len(table)
+                    new.append(r[i])
+                r[i] = n
+        out.append(r)
+
+    frame = {'t': snap.taken, 'h': snap.host, 'st': snap.status, 'v': snap.variables, 'n': new, 'r': out}
+    if keyframe:
+        frame['k'] = 1
+    return zlib.compress(json.dumps(frame, default=str, separators=(',', ':')).encode('utf-8'), 1)
+
+def decode_snapshot(frame, table):
+    ## the other way, table being the list of strings so far
+    if frame.get('k'):
+        del table[:]
+    table.extend(frame['n'])
+    rows = []
+    for r in frame['r']:
+        for i in RECORD_INTERNED_AT:
+            if r[i] is not None:
+                r[i] = table[r[i]]
+        row = dict(zip(RECORD_FIELDS, r))
+        if row['info_length'] is None:
+            ## recorded without the server trimming info, so there's nothing to say it's been trimmed
+            del row['info_length']
+            del row['info_keyword']
+        rows.append(row)
+    snap        = snapshot(rows, frame['st'], frame['v'], frame['h'])
+    snap.taken  = frame['t']
+    return snap
+
+class snapshot_recorder():
+    '''
+        Appends every snapshot to a --record file. The rows are copied as they go past, and the
+        encoding and writing happen on a background thread like the kill log, so a tick only pays for the copy.
+    '''
+    path        = None
+    lock        = None
+
+    def __init__(self, path):
+        self.path       = path
+        self.queue      = Queue()
+        self.table      = {}
+        self.count      = 0
+        self.keyframe   = 0
+        self.thread     = threading.Thread(target=self._run, name='snapshot_recorder')
+        self.thread.daemon = True
+
+    def open(self):
+        try:
+            self.fh     = open(self.path, 'ab+')
+            self.idx    = open(self.path + '.idx', 'ab+')
+            self._recover()
+        except (IOError, OSError) as e:
+            print(color_val("Unable to record to: {0}: {1}".format(self.path, e), Fore.RED + Style.BRIGHT), file=sys.stderr)
+            return False
+        self.thread.start()
+        atexit.register(self.close)
+        return True
+
+    def _recover(self):
+        '''
+            Picks up where the last recording left off. Frames that made it to the file but not the index get
+            indexed, and half a frame from a crash gets cut off.
+        '''
+        self.idx.seek(0, os.SEEK_END)
+        isize   = self.idx.tell() - (self.idx.tell() % RECORD_INDEX.size)
+        self.idx.truncate(isize)
+        self.fh.seek(0, os.SEEK_END)
+        size    = self.fh.tell()
+        end     = 0
+        if isize:
+            self.idx.seek(isize - RECORD_INDEX.size)
+            (t, offset, self.keyframe) = RECORD_INDEX.unpack(self.idx.read(RECORD_INDEX.size))
+            self.fh.seek(offset)
+            end = offset + RECORD_FRAME.size + RECORD_FRAME.unpack(self.fh.read(RECORD_FRAME.size))[0]
+        for (offset, frame) in read_frames(self.fh, end):
+            if frame.get('k'):
+                self.keyframe = offset
+            self.idx.write(RECORD_INDEX.pack(frame['t'], offset, self.keyframe))
+            end = offset + RECORD_FRAME.size + frame['size']
+        if end < size:
+            self.fh.truncate(end)
+        self.fh.seek(0, os.SEEK_END)
+        self.idx.flush()
+
+    def record(self, snap):
+        if isinstance(snap.rows, (list, tuple)):
+            self.queue.put((snap, record_rows(snap.rows)))
+        else:
+            snap.rows = self._tap(snap, snap.rows)
+
+    def _tap(self, snap, rows):
+        ## streaming: copy each row on its way to process_row(), and write the lot once the stream is done.
+        copied = []
+        for r in rows:
+            copied.append(tuple(r.get(f) for f in RECORD_FIELDS))
+            yield r
+        self.queue.put((snap, copied))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.fh.close()
+                self.idx.close()
+                return
+            self._write(*item)
+
+    def _write(self, snap, rows):
+        keyframe = self.count % RECORD_KEYFRAME_EVERY == 0 or len(self.table) > RECORD_MAX_STRINGS
+        if keyframe:
+            self.table = {}
+        data    = encode_snapshot(snap, rows, self.table, keyframe)
+        offset  = self.fh.tell()
+        if keyframe:
+            self.keyframe = offset
+        self.fh.write(RECORD_FRAME.pack(len(data)) + data)
+        self.fh.flush()
+        ## the frame goes first, so the index never points at something that isn't there
+        self.idx.write(RECORD_INDEX.pack(snap.taken, offset, self.keyframe))
+        self.idx.flush()
+        self.count += 1
+
+def read_frames(fh, offset):
+    '''
+        The frames in a --record file from offset on, as (offset, frame). Stops at the end, or at a frame that was only partly written.
+    '''
+    fh.seek(offset)
+    while True:
+        head = fh.read(RECORD_FRAME.size)
+        if len(head) < RECORD_FRAME.size:
+            return
+        size = RECORD_FRAME.unpack(head)[0]
+        data = fh.read(size)
+        if len(data) < size:
             return
-    else:
         try:
-            with open(args.kill_log, 'w+') as f:
-                pass
+            frame = json.loads(zlib.decompress(data).decode('utf-8'))
+        except (zlib.error, ValueError):
+            return
+        frame['size'] = size
+        yield (offset, frame)
+        offset += RECORD_FRAME.size + size
+
+class snapshot_reader():
+    '''
+        Reads a --record file back as snapshots taken from `start` up to (not including) `end`.
+        The first one is found through the index, then read from the keyframe before it.
+    '''
+    path = None
+
+    def __init__(self, path):
+        self.path = path
+
+    def find(self, start):
+        ## binary search on the index, (keyframe offset, offset) of the first snapshot taken at or after start
+        try:
+            idx = open(self.path + '.idx', 'rb')
         except IOError:
-            print(color_val("Unable to create: {0}".format(args.kill_log), Fore.RED + Style.BRIGHT), file=sys.stderr)
+            return (0, 0)
+        with idx:
+            idx.seek(0, os.SEEK_END)
+            (lo, hi) = (0, idx.tell() // RECORD_INDEX.size)
+            if not hi:
+                return (0, 0)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                idx.seek(mid * RECORD_INDEX.size)
+                if RECORD_INDEX.unpack(idx.read(RECORD_INDEX.size))[0] < start:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo == idx.tell() // RECORD_INDEX.size and lo:
+                lo -= 1
+            idx.seek(lo * RECORD_INDEX.size)
+            (t, offset, keyframe) = RECORD_INDEX.unpack(idx.read(RECORD_INDEX.size))
+            return (keyframe, offset)
+
+    def snapshots(self, start=None, end=None):
+        (keyframe, offset) = self.find(start) if start else (0, 0)
+        table   = []
+        with open(self.path, 'rb') as fh:
+            for (at, frame) in read_frames(fh, keyframe):
+                if end and frame['t'] >= end:
+                    return
+                if at < offset or (start and frame['t'] < start):
+                    ## only the strings are needed from the frames between the keyframe and the start
+                    if frame.get('k'):
+                        del table[:]
+                    table.extend(frame['n'])
+                    continue
+                yield decode_snapshot(frame, table)
+
+def parse_replay_time(val):
+    try:
+        return time.mktime(datetime.datetime.strptime(val, "%Y-%m-%d %H:%M:%S").timetuple())
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected YYYY-mm-dd HH:MM:SS, got: {0}".format(val))
+
+def replay():
+    '''
+        --replay: the recorded snapshots back through pslist(), with the gaps between them as recorded,
+        divided by --replay_speed (0 doesn't wait at all).
+    '''
+    if not os.path.isfile(args.replay):
+        print(color_val("ERROR: No such recording: {0}".format(args.replay), Fore.RED + Style.BRIGHT))
+        sys.exit(1)
+    prev = None
+    ## --replay_to is to the second, so it takes in that whole second
+    end  = args.replay_to + 1 if args.replay_to else None
+    for (counter, snap) in enumerate(snapshot_reader(args.replay).snapshots(args.replay_from, end)):
+        if prev is not None and args.replay_speed > 0:
+            OUTPUT.wait(max(snap.taken - prev, 0) / args.replay_speed)
+        prev = snap.taken
+        pslist(None, counter, snap)
+        TIMINGS.end_tick()
+
+class snapshot_agent():
+    '''
+        --agent: polls the server once a tick and sends each snapshot to every --attach client on a unix socket,
+        so the server sees one poller however many people are watching. A snapshot is encoded once, as a --record
+        keyframe, and every client gets the same bytes.
+        Each client has its own thread sending it the latest snapshot. One that's slower than the ticks misses the
+        ones in between rather than falling further and further behind, and never holds up the others.
+    '''
+    path        = None
+    sock        = None
+    latest      = None
+    generation  = 0
+    clients     = 0
+
+    def __init__(self, path):
+        self.path   = path
+        self.cond   = threading.Condition()
+
+    def listen(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                print(color_val("ERROR: An agent is already running on {0}".format(self.path), Fore.RED + Style.BRIGHT))
+                return False
+            except socket.error:
+                ## left behind by one that didn't get to clean up
+                os.unlink(self.path)
+            finally:
+                probe.close()
+        ## the snapshots have everyone's queries in them: the owner and their group only, from the moment it exists
+        umask = os.umask(0o117)
+        try:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(self.path)
+            self.sock.listen(AGENT_BACKLOG)
+        except (socket.error, OSError) as e:
+            print(color_val("ERROR: Unable to listen on {0}: {1}".format(self.path, e), Fore.RED + Style.BRIGHT))
+            return False
+        finally:
+            os.umask(umask)
+        atexit.register(self.close)
+
+        thread = threading.Thread(target=self._accept, name='snapshot_agent')
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def close(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _accept(self):
+        while True:
+            (conn, _) = self.sock.accept()
+            thread = threading.Thread(target=self._serve, args=(conn,), name='snapshot_agent_client')
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        with self.cond:
+            self.clients += 1
+        ## a new client gets the latest straight away, rather than waiting for the next tick
+        sent = 0
+        try:
+            while True:
+                with self.cond:
+                    while self.generation == sent:
+                        self.cond.wait()
+                    (sent, data) = (self.generation, self.latest)
+                conn.sendall(data)
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+            with self.cond:
+                self.clients -= 1
+
+    def publish(self, snap):
+        data = encode_snapshot(snap, record_rows(snap.rows), {}, True)
+        with self.cond:
+            self.latest     = RECORD_FRAME.pack(len(data)) + data
+            self.generation += 1
+            self.cond.notify_all()
+        return self.clients
+
+def run_agent():
+    agent = snapshot_agent(args.agent)
+    if not agent.listen():
+        sys.exit(1)
+
+    if args.loop_second_interval <= 0:
+        ## it's no use to anyone otherwise, and the connection should act like it's looping (prepared, reconnecting)
+        args.loop_second_interval = 3
+    source      = get_process_source(args.source)
+    query       = build_query(source)
+    schedule    = tick_scheduler(args.loop_second_interval)
+    print(color_val("{0} :: Agent for {1} listening on {2}, every {3}s".format(get_now_date(), get_hostname(), args.agent, schedule.interval),
+        Style.BRIGHT), file=sys.stderr)
+    clients     = 0
+    while 1:
+        schedule.start()
+        start   = time.time()
+        snap    = take_snapshot(query)
+        now     = agent.publish(snap)
+        TIMINGS.add('total', time.time() - start)
+        TIMINGS.end_tick()
+        if now != clients:
+            print("{0} :: Clients: {1}".format(get_now_date(), color_val(now, Fore.CYAN)), file=sys.stderr)
+            clients = now
+        idle(schedule.next(), db.connections)
+
+def recv_exact(sock, size):
+    buf = b''
+    while len(buf) < size:
+        data = sock.recv(size - len(buf))
+        if not data:
+            raise socket.error("The agent went away")
+        buf += data
+    return buf
+
+def local_filter():
+    '''
+        --attach: the agent sends everything it polled, so the filter options are applied here instead of by the server.
+        --kill_roots uses it too, the roots' rows come from an id lookup rather than the filtered process list query.
+        They're a kill_rule built from the options, with the same matching a --kill_policy rule has.
+    '''
+    spec = {}
+    if args.default:
+        spec['command'] = ['Query', 'Connect']
+    else:
+        for (opt, key) in (('command', 'command'), ('state', 'state'), ('time', 'min_time'), ('max_time', 'max_time'),
+                ('database', 'db'), ('match_user', 'user'), ('match_host', 'host')):
+            if getattr(args, opt) is not None:
+                spec[key] = getattr(args, opt)
+        if args.query:
+            ## LIKE 'query%'
+            spec['query'] = '^' + re.escape(args.query)
+
+    checks = []
+    if spec:
+        checks.append(kill_rule(dict(spec, threshold='off'), 0).matches)
+    if args.query_regex and not args.default:
+        regex = re.compile(args.query_regex, re.I)
+        checks.append(lambda row: row['info'] is not None and regex.search(row['info']) is not None)
+    if args.ignore_system_user:
+        checks.append(lambda row: row['user'] != 'system user')
+    return lambda row: all(c(row) for c in checks)
+
+def local_order():
+    ## [(field, descending)] from -o, applied in reverse since the sorts are stable
+    if args.default:
+        return [('time', False), ('id', False)]
+    if not args.order_by:
+        return []
+    order = []
+    for part in args.order_by.split(','):
+        words = part.split()
+        if words and words[0].lower() in PROCESS_FIELDS:
+            order.append((words[0].lower(), len(words) > 1 and words[1].lower() == 'desc'))
+    return order
+
+def agent_frames():
+    '''
+        The agent's snapshots as they come in, None when there isn't a new one yet. Only the newest is read out of
+        whatever has queued up (a slow render, or the last one took a while), the rest aren't worth showing.
+        If the agent goes away, keeps trying to get back to it. Only its socket's errors are handled here,
+        not whatever the rendering between frames runs into.
+    '''
+    failures = 0
+    while 1:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(args.attach)
+            failures = 0
+            while 1:
+                data = None
+                while select.select([sock], [], [], 0)[0]:
+                    data = recv_exact(sock, RECORD_FRAME.unpack(recv_exact(sock, RECORD_FRAME.size))[0])
+                yield data
+        except socket.error as e:
+            wait = random.uniform(0, min(RECONNECT_BACKOFF_BASE * 2 ** failures, RECONNECT_BACKOFF_MAX))
+            failures += 1
+            print(color_val("{0} :: Agent on {1}: {2}, retrying in {3}s".format(get_now_date(), args.attach, e, round(wait, 1)),
+                Fore.RED + Style.BRIGHT), file=sys.stderr)
+            OUTPUT.wait(wait)
+        finally:
+            sock.close()
+
+def attach():
+    '''
+        --attach: shows the snapshots an --agent sends, filtered and ordered here, through the same pslist() as always.
+    '''
+    keep    = local_filter()
+    order   = local_order()
+    counter = 0
+    for data in agent_frames():
+        if data is None:
+            ## nothing yet, let the output handle keys in the meantime
+            OUTPUT.wait(ATTACH_POLL)
+            continue
+        snap = decode_snapshot(json.loads(zlib.decompress(data).decode('utf-8')), [])
+        snap.rows = [r for r in snap.rows if keep(r)]
+        for (field, desc) in reversed(order):
+            snap.rows.sort(key=lambda r: (r[field] is None, r[field] if r[field] is not None else 0), reverse=desc)
+
+        counter += 1
+        start = time.time()
+        if pslist(None, counter, snap):
+            counter = 0
+        TIMINGS.add('total', time.time() - start)
+        TIMINGS.end_tick()
+
+def record_kill(row, host=None, latency=None):
+    global KILL_LOG
+    if KILL_LOG is None:
+        ## opened on the first kill, which with --hosts can be in several pool threads at once
+        with KILL_LOG_LOCK:
+            if KILL_LOG is None:
+                log = kill_logger(args.kill_log, args.kill_log_format, args.kill_log_fsync,
+                    int(args.kill_log_max_size * 1024 * 1024), args.kill_log_backups)
+                KILL_LOG = log if log.open() else False
+    if KILL_LOG:
+        KILL_LOG.record(row, host or get_hostname(), latency)
+
+class rate_limiter():
+    '''
+        Spaces calls out to at most rate per second across all threads. A rate of 0 doesn't limit anything.
+    '''
+    interval    = 0
+    next_at     = 0
+
+    def __init__(self, rate):
+        self.interval   = 1.0 / rate if rate else 0
+        self.next_at    = 0
+        self.lock       = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
             return
+        with self.lock:
+            now             = time.time()
+            at              = max(now, self.next_at)
+            self.next_at    = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+class kill_report():
+    '''
+        What happened to each thread we tried to kill during a tick, and how long it took.
+    '''
+    results = []
+    elapsed = 0
+
+    def __init__(self, results, elapsed):
+        self.results = results
+        self.elapsed = elapsed
+
+    def __len__(self):
+        return len(self.results)
+
+    def count(self, outcome):
+        return sum(1 for r in self.results if r[1] == outcome)
+
+    @property
+    def killed(self):
+        return self.count('killed')
+
+    def __str__(self):
+        latencies = [r[2] for r in self.results] or [0]
+        return "killed: {0}, already gone: {1}, denied: {2}, errors: {3} :: {4}/s, latency avg: {5}ms, max: {6}ms".format(
+            self.killed, self.count('gone'), self.count('denied'), self.count('error'),
+            round(len(self.results) / self.elapsed, 1) if self.elapsed else len(self.results),
+            round(sum(latencies) / len(latencies) * 1000, 2), round(max(latencies) * 1000, 2))
+
+class kill_engine():
+    '''
+        Sends the KILLs for a tick out over a small pool of connections to the same server,
+        no faster than the kill rate allows.
+        The connection the process list came from is part of the pool, so if the server is too full
+        to accept more connections we still have at least that one.
+    '''
+    conns       = []
+    idle        = None
+    pool        = None
+    limiter     = None
+    sql         = "KILL %s"
+
+    def __init__(self, conn, concurrency=1, rate=0, query_only=False):
+        self.conns      = [conn]
+        self.idle       = Queue()
+        self.limiter    = rate_limiter(rate)
+        self.sql        = "KILL QUERY %s" if query_only else "KILL %s"
+
+        for i in range(max(concurrency, 1) - 1):
+            other = conn.clone()
+            try:
+                other.connect()
+            except pymysql.Error:
+                ## we'll get by with fewer
+                break
+            self.conns.append(other)
+
+        for c in self.conns:
+            self.idle.put(c)
+        from multiprocessing.pool import ThreadPool
+        self.pool = ThreadPool(len(self.conns))
+
+    def kill(self, rows):
+        ## the process list's connection mustn't exit, or sit out a backoff, in a pool thread.
+        ## While the pool has it, a failure is just that kill's outcome, like on the others.
+        main                = self.conns[0]
+        exit_on_error       = main.exit_on_error
+        main.exit_on_error  = False
+        start   = time.time()
+        try:
+            results = self.pool.map(self._kill, rows)
+        finally:
+            main.exit_on_error = exit_on_error
+        return kill_report(results, time.time() - start)
+
+    def _kill(self, row):
+        self.limiter.wait()
+        conn    = self.idle.get()
+        start   = time.time()
+        outcome = 'killed'
+        try:
+            ## no reconnecting and retrying here, a thread that's already gone would just fail again
+            conn.query(self.sql, (row['id'],), reconnect=False)
+        except pymysql.Error as e:
+            outcome = KILL_OUTCOMES.get(e.args[0], 'error')
+        finally:
+            self.idle.put(conn)
+        return (row, outcome, time.time() - start)
+
+## --kill_policy: what a rule can say about a row. Lists are any of, host is a prefix and query a regular expression.
+POLICY_CONDITIONS   = ('user', 'host', 'db', 'command', 'state', 'keyword', 'query', 'fingerprint', 'min_time', 'max_time')
+POLICY_SETTINGS     = ('name', 'threshold', 'max_kills')
+
+class policy_error(Exception):
+    pass
 
-    kill_string = "{0} :: {1} :: {2}\n".format(get_now_date(), get_hostname(), ', '.join("%s: %s" % (k, v) for (k, v) in row.iteritems()))
-    with open(args.kill_log, 'a') as f:
-        f.write(kill_string)
+def parse_threshold(val):
+    ## a Threads_connected level, or 'off' (None) to kill whatever the connections
+    if val is None or str(val).lower() == 'off':
+        return None
+    try:
+        return int(val)
+    except ValueError:
+        raise policy_error("threshold must be a number or off, not: {0}".format(val))
+
+class kill_rule():
+    '''
+        One rule of a --kill_policy, compiled into a single predicate when it's loaded: the lists become frozensets,
+        the regex is compiled, and only the checks the rule asks for end up in it.
+    '''
+    name        = None
+    threshold   = None
+    max_kills   = None
+    matches     = None
+
+    def __init__(self, spec, n):
+        unknown = set(spec) - set(POLICY_CONDITIONS + POLICY_SETTINGS)
+        if unknown:
+            raise policy_error("rule {0}: unknown key(s): {1}".format(n, ', '.join(sorted(unknown))))
+        self.name       = str(spec.get('name') or "rule {0}".format(n))
+        self.threshold  = parse_threshold(spec.get('threshold', args.kill_threshold))
+        self.max_kills  = int(spec['max_kills']) if spec.get('max_kills') is not None else None
+
+        checks = []
+        for field in ('user', 'db', 'command'):
+            if spec.get(field) is not None:
+                checks.append(self.any_of(field, spec[field]))
+        if spec.get('state') is not None:
+            states = self.values(spec['state'], str.lower)
+            checks.append(lambda row: (row['state'] or '').lower() in states)
+        if spec.get('keyword') is not None:
+            keywords = self.values(spec['keyword'], str.lower)
+            checks.append(lambda row: get_keyword(row) in keywords)
+        if spec.get('host') is not None:
+            hosts = tuple(self.values(spec['host']))
+            checks.append(lambda row: (row['host'] or '').startswith(hosts))
+        if spec.get('query') is not None:
+            try:
+                regex = re.compile(spec['query'], re.I | re.S)
+            except re.error as e:
+                raise policy_error("{0}: bad query regex: {1}".format(self.name, e))
+            checks.append(lambda row: row['info'] is not None and regex.search(row['info']) is not None)
+        if spec.get('fingerprint') is not None:
+            wanted = str(spec['fingerprint'])
+            checks.append(lambda row: matches_fingerprint(row, wanted))
+        if spec.get('min_time') is not None:
+            min_time = int(spec['min_time'])
+            checks.append(lambda row: int(row['time'] or 0) >= min_time)
+        if spec.get('max_time') is not None:
+            max_time = int(spec['max_time'])
+            checks.append(lambda row: int(row['time'] or 0) <= max_time)
+
+        if not checks:
+            raise policy_error("{0}: a rule needs at least one of: {1}".format(self.name, ', '.join(POLICY_CONDITIONS)))
+        if len(checks) == 1:
+            self.matches = checks[0]
+        else:
+            checks = tuple(checks)
+            self.matches = lambda row: all(c(row) for c in checks)
+
+    @staticmethod
+    def values(val, fn=str):
+        return frozenset(fn(str(v)) for v in (val if isinstance(val, (list, tuple)) else [val]))
+
+    def any_of(self, field, val):
+        ## case doesn't matter, as it doesn't in the server's comparisons (-c query is every Query thread)
+        vals = self.values(val, str.lower)
+        return lambda row: row[field] is not None and row[field].lower() in vals
+
+    def describe(self):
+        return "threshold: {0}, max kills: {1}".format(self.threshold if self.threshold is not None else 'off',
+            self.max_kills if self.max_kills is not None else 'no limit')
+
+class kill_policy():
+    '''
+        The rules of a --kill_policy file, in the order they're written. Each row goes to the first rule that matches it,
+        so a row is only ever counted (and killed) once. A rule only takes part while Threads_connected is at its threshold,
+        and stops picking once it has max_kills for the tick, but still claims the rows it matches.
+    '''
+    path    = None
+    rules   = []
+
+    def __init__(self, path, spec):
+        self.path = path
+        if isinstance(spec, dict):
+            spec = spec.get('rules')
+        if not isinstance(spec, list) or not spec:
+            raise policy_error("expected a list of rules, or a rules: key with one")
+        self.rules = []
+        for (n, rule) in enumerate(spec, 1):
+            if not isinstance(rule, dict):
+                raise policy_error("rule {0}: expected a mapping, got: {1}".format(n, rule))
+            self.rules.append(kill_rule(rule, n))
+
+    def evaluate(self, snap, timed=False):
+        '''
+            One pass over the process list. Returns [(rule, matched, picked rows, seconds spent matching)], in rule order.
+            The time is only measured when timed, it costs more than most of the checks do.
+        '''
+        ct      = snap.connected_threads
+        active  = [(i, r) for (i, r) in enumerate(self.rules) if r.threshold is None or ct >= r.threshold]
+        matched = [0] * len(self.rules)
+        picked  = [[] for r in self.rules]
+        spent   = [0.0] * len(self.rules)
+        nrows   = 0
+
+        for row in snap.rows:
+            nrows += 1
+            for (i, rule) in active:
+                if timed:
+                    t   = monotonic()
+                    hit = rule.matches(row)
+                    spent[i] += monotonic() - t
+                else:
+                    hit = rule.matches(row)
+                if hit:
+                    matched[i] += 1
+                    if rule.max_kills is None or len(picked[i]) < rule.max_kills:
+                        row['kill_rule'] = rule.name
+                        picked[i].append(row)
+                    break
+        TIMINGS.add('rows', nrows)
+        return [(r, matched[i], picked[i], spent[i]) for (i, r) in enumerate(self.rules)]
+
+def load_kill_policy(path):
+    try:
+        with open(path, 'r') as f:
+            return kill_policy(path, yaml.safe_load(f))
+    except (IOError, yaml.YAMLError, policy_error, ValueError) as e:
+        print(color_val("ERROR: Unable to load the kill policy {0}: {1}".format(path, e), Fore.RED + Style.BRIGHT))
+        sys.exit(1)
 
-def killah(results):
+def print_policy(snap, results, dry_run):
+    out = sys.stderr if OUTPUT.machine else sys.stdout
+    if dry_run:
+        print(color_val("{0} :: {1} :: Dry run, would kill: {2} (connected threads: {3})".format(get_now_date(snap.taken), snap.host,
+            sum(len(p) for (r, m, p, t) in results), snap.connected_threads), Fore.YELLOW + Style.BRIGHT), file=out)
+    for (rule, matched, picked, spent) in results:
+        if not dry_run and not picked:
+            continue
+        line = "\t({0}) {1} {2} of {3} matching ({4})".format(color_val(rule.name, Fore.GREEN), 'would kill' if dry_run else 'picked',
+            color_val(len(picked), Fore.RED if picked else Fore.CYAN), matched, rule.describe())
+        if rule.threshold is not None and snap.connected_threads < rule.threshold:
+            line += ", under threshold"
+        if dry_run:
+            line += ", matching took {0}ms".format(round(spent * 1000, 3))
+            if picked:
+                line += ": {0}".format(', '.join(str(r['id']) for r in picked[:20]) + (' ...' if len(picked) > 20 else ''))
+        print(line, file=out)
+
+def over_kill_threshold(snap):
     ## ok. is it an integer and are the connected threads greater than the kill threshold ?
     try:
         args.kill_threshold = int(args.kill_threshold)
-        ct = get_connected_threads()
+        ct = snap.connected_threads
         if ct < args.kill_threshold:
             print("Connected threads: {0}, Kill threshold: {1}. Not killing at this time".format(ct, args.kill_threshold), file=sys.stderr)
-            return
+            return False
     except ValueError:
         if args.kill_threshold.lower() != 'off':
             ## if we haven't set this to off, then no killing
             print("kill threshold was set but doesn't = off. Not killing at this time.", file=sys.stderr)
-            return
+            return False
+    return True
+
+def killah(snap, conn=None):
+    conn = conn or db
+    ## a policy's rules each have their own threshold
+    if not POLICY and not over_kill_threshold(snap):
+        return
 
-    sql = "KILL %s"
-    killed = 0
-    for row in results:
-        if not args.kill_all:
-            if not row['info'].lower().startswith('select'):
+    start   = time.time()
+    victims = []
+    nrows   = 0
+    if POLICY:
+        results = POLICY.evaluate(snap, timed=args.kill_dry_run)
+        print_policy(snap, results, args.kill_dry_run)
+        if not args.kill_dry_run:
+            victims = [row for (rule, matched, picked, spent) in results for row in picked]
+    elif args.kill_roots:
+        ## the root blockers, whatever they're running (often nothing, a transaction left open).
+        ## The process list still has to be read to the end, the connection is needed for describe().
+        ## The filter options still apply, same as they would to the process list (replication threads are never picked).
+        for row in snap.rows:
+            nrows += 1
+        keep = local_filter()
+        victims = [r for r in (snap.locks.describe() if snap.locks else ()) if snap.locks.roots.get(r['id'], 0) >= args.kill_roots and
+            r['command'] != 'Binlog Dump' and keep(r) and
+            (not args.kill_fingerprint or matches_fingerprint(r, args.kill_fingerprint))]
+        TIMINGS.add('rows', nrows)
+    else:
+        for row in snap.rows:
+            nrows += 1
+            if not args.kill_all:
+                ## a prefix, not the keyword: 'select*from t' is a select too, whatever its first word is
+                if (row['info'] or '').lstrip()[:6].lower() != 'select':
+                    continue
+            if args.kill_fingerprint and not matches_fingerprint(row, args.kill_fingerprint):
                 continue
-        if db.query(sql, (row['id'],)):
-            record_kill(row)
-            killed += 1
-    return killed
+            victims.append(row)
+        TIMINGS.add('rows', nrows)
+
+    if not victims:
+        TIMINGS.add('kill', time.time() - start)
+        return None
+
+    ## reading the rows above finished off any stream, so the connection is free again.
+    fetch_full_info(victims, snap.source, conn)
+
+    report = conn.kill_engine().kill(victims)
+    for (row, outcome, latency) in report.results:
+        if outcome == 'killed':
+            record_kill(row, snap.host, latency)
+    TIMINGS.add('kill', time.time() - start)
+    return report
+
+def fetch_full_info(rows, source, conn):
+    '''
+        The process list only carried the start of long queries. The kill log should have all of it,
+        so fetch the full text, but only for the rows we're about to kill, in one query.
+    '''
+    trimmed = [r for r in rows if r.get('info_length') and r['info_length'] > len(r['info'] or '')]
+    if not trimmed or not source:
+        return
+
+    ids = [r['id'] for r in trimmed]
+    sql = "{0} WHERE {1} IN ({2})".format(source.select_sql(['id', 'info']), source.col('id'), ', '.join(['%s'] * len(ids)))
+    full = dict((r['id'], r['info']) for r in conn.query(sql, ids).fetchall())
+
+    for r in trimmed:
+        ## between the snapshot and the kill the thread may have moved on to something else. Then the log gets
+        ## the start we had and the length it was, rather than another query's text.
+        if r['id'] in full and (full[r['id']] or '').startswith(r['info'] or ''):
+            r['info']           = full[r['id']]
+            r['info_length']    = len(r['info'] or '')
+
+## turns a query into its shape: literals become ?, IN lists and multi-row VALUES collapse to (?+),
+## comments go away and whitespace collapses. Strings go first so nothing inside them looks like a comment or a number.
+FINGERPRINT_RULES = (
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\""),                   '?'),
+    (re.compile(r'/\*.*?\*/|(?:--|#)[^\n]*', re.S),                                 ' '),
+    (re.compile(r'(?<![\w.])-?(?:0x[0-9a-f]+|\d+(?:\.\d+)?(?:e[+-]?\d+)?)\b', re.I), '?'),
+    (re.compile(r'\s+'),                                                            ' '),
+    (re.compile(r'\bin ?\( ?\?(?: ?, ?\?)* ?\)', re.I),                              'in(?+)'),
+    (re.compile(r'\bvalues ?\([^()]*\)(?: ?, ?\([^()]*\))*', re.I),                  'values(?+)'),
+)
+FINGERPRINT_CACHE       = {}
+FINGERPRINT_CACHE_SIZE  = 10000
+
+def get_fingerprint(info):
+    '''
+        Returns (fingerprint, fingerprint id) for a query. The same statements come around tick after tick,
+        so results are cached by a hash of the raw text and each one is only worked out once.
+
+        Only the first INFO_TRIM_LENGTH characters count, since that's all the server sends when trimming (-T, and
+        always when killing). A statement gets the same id whether it came trimmed, with " ..." on the end, or in full,
+        so statements that only differ after that many characters are one fingerprint.
+    '''
+    info = info[:INFO_TRIM_LENGTH]
+    key = hash(info)
+    fp  = FINGERPRINT_CACHE.get(key)
+    if fp is not None:
+        return fp
+
+    text = info
+    for (regex, repl) in FINGERPRINT_RULES:
+        text = regex.sub(repl, text)
+    text = text.strip().lower()
+
+    fp = (text, hashlib.md5(text if isinstance(text, bytes) else text.encode('utf-8')).hexdigest()[:16])
+
+    if len(FINGERPRINT_CACHE) >= FINGERPRINT_CACHE_SIZE:
+        ## a new set of statements has shown up, start over rather than grow forever
+        FINGERPRINT_CACHE.clear()
+    FINGERPRINT_CACHE[key] = fp
+    return fp
+
+def matches_fingerprint(row, wanted):
+    if not row['info'] or row['info'] == '--':
+        return False
+    return wanted in get_fingerprint(row['info'])
+
+class fingerprint_stats():
+    '''
+        Connections, total time and max time per statement shape, for one tick.
+    '''
+    stats = {}
+
+    def __init__(self):
+        self.stats = {}
+
+    def add(self, row):
+        if not row['info'] or row['info'] == '--':
+            return
+        (fp, fp_id) = get_fingerprint(row['info'])
+        t           = int(row['time'] or 0)
+        st          = self.stats.get(fp_id)
+        if st is None:
+            self.stats[fp_id] = [fp, 1, t, t]
+        else:
+            st[1] += 1
+            st[2] += t
+            st[3] = max(st[3], t)
+
+    def top(self, n):
+        ## the shapes hogging the most connections
+        return heapq.nlargest(n, self.stats.items(), key=lambda kv: (kv[1][1], kv[1][2]))
+
+def print_fingerprints(fps, n):
+    for (fp_id, (fp, count, total, longest)) in fps.top(n):
+        print("\t({0}) {1} count: {2}, total time: {3}s, max time: {4}s :: {5}".format(color_val("Fingerprint", Fore.GREEN),
+            color_val(fp_id, Fore.YELLOW), color_val(count, Fore.CYAN), color_val(total, Fore.CYAN), color_val(longest, Fore.CYAN),
+            fp[:INFO_TRIM_LENGTH]))
+
+def get_keyword(row):
+    ## the first word of the query - newline, tab or whitespace, lowercased. The server works it out for us when info is trimmed.
+    if row.get('info_keyword') is not None:
+        return row['info_keyword']
+    if row['info'] and row['info'].split():
+        return row['info'].split()[0].lower()
+    return '--'
+
+class stage_timings():
+    '''
+        Where the time goes in a tick. Each stage is summed over the tick (and over the hosts when watching several),
+        and the last `window` ticks are kept for rolling p50/p95/max.
+        query is sending the batch and reading its first result, fetch is reading the rest of it (the process list).
+        When streaming, the process list is read as the rows are processed, so most of fetch shows up under process.
+    '''
+    stages  = ('connect', 'query', 'fetch', 'process', 'render', 'kill', 'log', 'total')
+    counts  = ('rows', 'bytes')
+
+    def __init__(self, window=TIMINGS_WINDOW):
+        self.lock   = threading.Lock()
+        self.tick   = defaultdict(float)
+        self.ticks  = 0
+        self.window = dict((k, deque(maxlen=window)) for k in self.stages + self.counts)
+
+    def add(self, stage, val):
+        ## the kill log thread and the host pool threads add to this too
+        with self.lock:
+            self.tick[stage] += val
+
+    def end_tick(self):
+        with self.lock:
+            (tick, self.tick) = (self.tick, defaultdict(float))
+            self.ticks += 1
+        for (k, vals) in self.window.items():
+            vals.append(tick.get(k, 0))
+        return tick
+
+    def percentiles(self, key):
+        vals = sorted(self.window[key])
+        if not vals:
+            return (0, 0, 0)
+        return (vals[len(vals) // 2], vals[min(int(len(vals) * .95), len(vals) - 1)], vals[-1])
+
+def format_tick_timings(tick):
+    return ', '.join(["{0}: {1}ms".format(k, round(tick.get(k, 0) * 1000, 1)) for k in stage_timings.stages] +
+        ["{0}: {1}".format(k, int(tick.get(k, 0))) for k in stage_timings.counts])
+
+def print_timings(signal=None, frame=None):
+    ## SIGUSR1, or whenever. stderr, so it doesn't end up in the middle of --format output.
+    print("{0} :: Timings over the last {1} ticks".format(get_now_date(), len(TIMINGS.window['total'])), file=sys.stderr)
+    for k in stage_timings.stages:
+        print("\t({0}) p50: {1}ms, p95: {2}ms, max: {3}ms".format(color_val(k, Fore.GREEN),
+            *[round(v * 1000, 1) for v in TIMINGS.percentiles(k)]), file=sys.stderr)
+    for k in stage_timings.counts:
+        print("\t({0}) p50: {1}, p95: {2}, max: {3}".format(color_val(k, Fore.GREEN),
+            *[int(v) for v in TIMINGS.percentiles(k)]), file=sys.stderr)
+    if SCHEDULER:
+        print("\t({0}) interval: {1}s, skipped: {2}, late: {3}".format(color_val('ticks', Fore.GREEN),
+            round(SCHEDULER.interval, 3), SCHEDULER.skipped, SCHEDULER.late), file=sys.stderr)
 
 def show_processing_time(start, end, text='Processing time'):
     elapsed     = round(end - start, 3)
@@ -447,31 +2364,655 @@ def show_processing_time(start, end, text='Processing time'):
 
     print("\t({0}): {1}".format(color_val(text, Fore.GREEN), elapsed_str))
 
-def process_row(results):
-    calculate_sleepers = False
+class thread_record(object):
+    '''
+        What we remember about one thread between ticks. Kept small, there can be thousands of these.
+    '''
+    __slots__ = ('id', 'user', 'host', 'db', 'command', 'state', 'time', 'started', 'info')
+
+    def __init__(self, row, now):
+        self.id         = row['id']
+        self.started    = now - int(row['time'] or 0)
+        self.update(row)
+
+    def update(self, row):
+        self.user       = row['user']
+        self.host       = row['host']
+        self.db         = row['db']
+        self.command    = row['command']
+        self.state      = row['state']
+        self.time       = int(row['time'] or 0)
+        self.info       = (row['info'] or '')[:HISTORY_INFO_LENGTH]
+
+class tick_record(object):
+    '''
+        One tick in the history: when it was, the stats as a tuple in STAT_KEYS order, and the thread churn.
+    '''
+    __slots__ = ('when', 'stats', 'new', 'finished', 'running')
+
+    def __init__(self, when, stats, new, finished, running):
+        self.when       = when
+        self.stats      = stats
+        self.new        = new
+        self.finished   = finished
+        self.running    = running
+
+class process_history():
+    '''
+        A ring buffer of the last size ticks, plus a record for every thread seen on the last one.
+        Threads drop out as soon as they're gone, so memory is bounded by the ring size and the
+        size of the process list, however long we loop for.
+    '''
+    size        = 0
+    ticks       = None
+    threads     = {}
+    seen        = set()
+    new         = 0
+
+    def __init__(self, size):
+        self.size       = size
+        self.ticks      = deque(maxlen=size)
+        self.threads    = {}
+        self.seen       = set()
+        self.new        = 0
+
+    def observe(self, row, now):
+        rec = self.threads.get(row['id'])
+        if rec is None:
+            self.threads[row['id']] = thread_record(row, now)
+            self.new += 1
+        else:
+            if int(row['time'] or 0) < rec.time:
+                ## same connection, but it's moved on to another statement
+                rec.started = now - int(row['time'] or 0)
+            rec.update(row)
+        self.seen.add(row['id'])
+
+    def end_tick(self, nums, now):
+        finished = [i for i in self.threads if i not in self.seen]
+        for i in finished:
+            del self.threads[i]
+
+        stats = tuple(nums[k] for k in STAT_KEYS) if nums else (0,) * len(STAT_KEYS)
+        self.ticks.append(tick_record(now, stats, self.new, len(finished), len(self.seen) - self.new))
+        self.seen   = set()
+        self.new    = 0
+
+    @property
+    def last(self):
+        return self.ticks[-1] if self.ticks else None
+
+    def growth(self):
+        ## change per minute of each stat, across the whole window
+        if len(self.ticks) < 2:
+            return None
+        first, last = self.ticks[0], self.ticks[-1]
+        minutes     = (last.when - first.when) / 60.0
+        if not minutes:
+            return None
+        return dict((k, (last.stats[i] - first.stats[i]) / minutes) for (i, k) in enumerate(STAT_KEYS))
+
+    def longest(self, n):
+        return heapq.nlargest(n, self.threads.values(), key=lambda r: r.time)
+
+def print_history(hist):
+    last = hist.last
+    if not args.stats:
+        ## with --stats there are no threads to follow, only the numbers
+        print("\t({0}) new: {1}, finished: {2}, still running: {3}".format(color_val("Threads", Fore.GREEN),
+            color_val(last.new, Fore.CYAN), color_val(last.finished, Fore.CYAN), color_val(last.running, Fore.CYAN)))
+
+    growth = hist.growth()
+    if growth:
+        print("\t({0}) {1}".format(color_val("Per minute", Fore.GREEN), ', '.join("{0}: {1}".format(k.replace('num_', '').replace('_', ' ').upper(),
+            color_val("{0:+.1f}".format(growth[k]), Fore.RED if growth[k] > 0 else Fore.CYAN)) for k in STAT_KEYS)))
+
+    for rec in hist.longest(args.top):
+        print("\t({0}) {1} {2}@{3} {4}s: {5}".format(color_val("Longest", Fore.GREEN), rec.id, rec.user, rec.host,
+            color_val(rec.time, Fore.YELLOW), rec.info))
+
+class text_output():
+    '''
+        The usual terminal output, one formatted line per process, written out together once they're all formatted.
+    '''
+    machine = False
+    live    = False
+    lines   = None
+    size    = 0
+    headed  = None
+
+    def __init__(self):
+        self.lines = []
+
+    def row(self, snap, row):
+        line = OUT_FORMAT.format(row['id'], row['user'], row['host'], row['db'], row['command'], row['time'], row['state'], row['info'])
+        self.lines.append(line)
+        self.size += len(line) + 1
+        if args.stream and self.size > OUTPUT_BUFFER_BYTES:
+            ## same as record_output, --stream doesn't get to hold the whole list here either.
+            ## The header has to go out first, without the blockers, those need the whole list read.
+            if self.headed is not snap:
+                print_header(snap, blockers=False)
+                self.headed = snap
+            self.flush()
+
+    def header(self, snap):
+        ## once the whole list has been read. If some of it already went out, the blockers follow the rows instead.
+        if self.headed is not snap:
+            print_header(snap)
+        elif snap.locks:
+            self.flush()
+            print_blockers(snap.locks)
+        self.headed = None
+
+    def summary(self, snap, nums):
+        pass
+
+    def timings(self, tick):
+        print("\t({0}) {1}".format(color_val("Timings", Fore.GREEN), format_tick_timings(tick)))
+
+    def flush(self):
+        if self.lines:
+            self.lines.append('')
+            sys.stdout.write("\n".join(self.lines))
+            self.lines = []
+            self.size = 0
+
+    def wait(self, seconds):
+        time.sleep(seconds)
+
+class record_output():
+    '''
+        jsonl, csv or tsv for piping into something else. One record per process and one summary per tick,
+        named after the process list fields and the process_row() stats.
+        Everything for a tick is buffered and written out in one go.
+    '''
+    machine     = True
+    live        = False
+    fmt         = 'jsonl'
+    columns     = ('type', 'date', 'server') + PROCESS_FIELDS + STAT_KEYS + ('user_count', 'connected_threads', 'max_connections',
+        'reconnects', 'disconnected_seconds', 'lock_waits')
+    buf         = None
+    writer      = None
+    date        = None
+
+    def __init__(self, fmt):
+        self.fmt    = fmt
+        self.buf    = StringIO()
+        if fmt != 'jsonl':
+            import csv
+            self.writer = csv.writer(self.buf, delimiter='\t' if fmt == 'tsv' else ',', lineterminator='\n')
+            self.writer.writerow(self.columns)
+
+    def write(self, rec):
+        if self.writer:
+            self.writer.writerow([rec.get(c) for c in self.columns])
+        else:
+            self.buf.write(json.dumps(rec, default=str, separators=(',', ':')))
+            self.buf.write("\n")
+
+    def row(self, snap, row):
+        rec = {'type': 'process', 'date': self.tick_date(snap.taken), 'server': snap.host}
+        for f in PROCESS_FIELDS:
+            ## undo the '--' placeholders, empty is empty
+            rec[f] = None if row[f] == '--' else row[f]
+        self.write(rec)
+        if args.stream and self.buf.tell() > OUTPUT_BUFFER_BYTES:
+            ## streaming is about not holding the whole list, so don't hold all of it here either
+            self.flush(False)
+
+    def summary(self, snap, nums):
+        rec = {'type': 'summary', 'date': self.tick_date(snap.taken), 'server': snap.host,
+            'connected_threads': snap.connected_threads, 'max_connections': snap.max_connections,
+            'reconnects': snap.reconnects, 'disconnected_seconds': round(snap.disconnected, 3)}
+        ## a tick that found nothing still gets its summary, with the stats at zero
+        user_count = nums['user_count'] if nums else {}
+        for k in STAT_KEYS:
+            rec[k] = nums[k] if nums else 0
+        if self.writer:
+            rec['user_count'] = ';'.join("{0}={1}".format(u, c) for (u, c) in sorted(user_count.items()))
+        else:
+            rec['user_count'] = user_count
+        if snap.locks:
+            rec['lock_waits'] = len(snap.locks.waiting)
+            if not self.writer:
+                rec['blockers'] = [dict(((f, r[f]) for f in PROCESS_FIELDS), blocked=snap.locks.roots.get(r['id'], 0))
+                    for r in snap.locks.describe()]
+        self.write(rec)
+
+    def tick_date(self, when=None):
+        if not self.date:
+            self.date = get_now_date(when)
+        return self.date
+
+    def flush(self, end_tick=True):
+        sys.stdout.write(self.buf.getvalue())
+        sys.stdout.flush()
+        self.buf.seek(0)
+        self.buf.truncate()
+        if end_tick:
+            self.date = None
+
+    def error(self, label, err):
+        print("({0}) ERROR: {1}".format(label, err), file=sys.stderr)
+
+    def timings(self, tick):
+        if self.writer:
+            ## no columns for these in csv/tsv
+            print("{0} :: {1}".format(self.tick_date(), format_tick_timings(tick)), file=sys.stderr)
+            return
+        rec = {'type': 'timings', 'date': self.tick_date()}
+        for k in stage_timings.stages:
+            rec[k + '_ms'] = round(tick.get(k, 0) * 1000, 3)
+        for k in stage_timings.counts:
+            rec[k] = int(tick.get(k, 0))
+        self.write(rec)
+
+    def wait(self, seconds):
+        time.sleep(seconds)
+
+class tui_column():
+    __slots__ = ('field', 'title', 'fmt', 'x', 'width', 'numeric')
+
+    def __init__(self, field, title, spec, x, width):
+        self.field      = field
+        self.title      = title
+        self.fmt        = "{0" + spec + "}"
+        self.x          = x
+        self.width      = width
+        self.numeric    = field in ('id', 'time')
+
+class tui_output():
+    '''
+        A full screen live view for looping. The threads gauge and the stats stay pinned at the top, and
+        only the cells that changed since the last tick get written to the terminal, so a tick where
+        the same threads are still running costs a handful of TIME cells rather than the whole list.
+        Keys: 1-8 sort by that column (again to reverse), 0 back to server order, arrows/pgup/pgdn scroll, q quits.
+    '''
+    machine     = True
+    live        = True
+    scr         = None
+    columns     = None
+    rows        = None      ## the tick being collected
+    headers     = None
+    shown_rows  = None      ## the last full tick, kept so sorting and scrolling don't need a new one
+    shown_hdrs  = None
+    seen        = None      ## thread ids from the tick before, anything else is new and gets highlighted
+    drawn       = None      ## screen line -> the cells written there, which is all that gets diffed against
+    sort_col    = None
+    sort_desc   = False
+    top         = 0
+    unprintable = re.compile(r'[\s\x00-\x1f\x7f]+')
+
+    def __init__(self):
+        self.rows       = []
+        self.headers    = []
+        self.shown_rows = []
+        self.shown_hdrs = []
+        self.drawn      = {}
+        self.columns    = []
+        x = 0
+        ## same layout as the text output
+        for (field, title, (spec, width)) in zip(PROCESS_FIELDS, OUT_TITLES, re.findall(r'\{\d+(:<?(\d+))\}', OUT_FORMAT)):
+            self.columns.append(tui_column(field, title, spec, x, int(width)))
+            x += int(width)
+
+    def start(self):
+        self.scr = curses.initscr()
+        atexit.register(self.stop)
+        curses.noecho()
+        curses.cbreak()
+        self.scr.keypad(1)
+        try:
+            curses.curs_set(0)
+        except curses.error:
+            pass
+        if curses.has_colors():
+            curses.start_color()
+            for (pair, color) in enumerate((curses.COLOR_RED, curses.COLOR_YELLOW, curses.COLOR_CYAN, curses.COLOR_GREEN), 1):
+                curses.init_pair(pair, color, curses.COLOR_BLACK)
+
+    def stop(self):
+        if self.scr and not curses.isendwin():
+            curses.nocbreak()
+            self.scr.keypad(0)
+            curses.echo()
+            curses.endwin()
+
+    def color(self, pair):
+        return curses.color_pair(pair) if curses.has_colors() else 0
+
+    def row(self, snap, row):
+        self.rows.append(row)
+
+    def timings(self, tick):
+        pass
+
+    def summary(self, snap, nums):
+        self.headers.append((snap, nums))
+
+    def flush(self):
+        if not self.scr:
+            self.start()
+        else:
+            self.seen   = set(r['id'] for r in self.shown_rows)
+        self.shown_rows = self.rows
+        self.shown_hdrs = self.headers
+        self.rows       = []
+        self.headers    = []
+        self.draw()
+
+    def sorted_rows(self):
+        if self.sort_col is None:
+            return self.shown_rows
+        c = self.columns[self.sort_col]
+        if c.numeric:
+            key = lambda r: int(r[c.field] or 0)
+        else:
+            key = lambda r: r[c.field] or ''
+        return sorted(self.shown_rows, key=key, reverse=self.sort_desc)
+
+    def header_lines(self):
+        lines = []
+        for (snap, nums) in self.shown_hdrs:
+            ct = snap.connected_threads
+            mc = snap.max_connections
+            if ct > (mc * .75):
+                pair = 1
+            elif ct > (mc * .5):
+                pair = 2
+            else:
+                pair = 3
+            lines.append(((snap.host, self.color(4)), (" :: {0} :: Threads (".format(get_now_date(snap.taken)), 0),
+                ("{0}".format(ct), self.color(pair)), (" / {0})".format(mc), 0)))
+            if nums:
+                lines.append((("Processes: {0}  Sleepers: {1}  Locked: {2}  Reads: {3}  Writes: {4}  Opening: {5}  Closing: {6}  Past long_query_time: {7}".format(
+                    nums['num_processes'], nums['num_sleepers'], nums['num_locked'], nums['num_reads'], nums['num_writes'],
+                    nums['num_opening'], nums['num_closing'], nums['num_past_long_query']), 0),))
+            else:
+                lines.append((("Nothing found", curses.A_BOLD),))
+        if self.sort_col is None:
+            order = "server order"
+        else:
+            order = "{0} {1}".format(self.columns[self.sort_col].title, "desc" if self.sort_desc else "asc")
+        lines.append((("Sorted by {0} :: 1-8 sort, 0 server order, arrows scroll, q quit".format(order), curses.A_DIM),))
+        return lines
+
+    def draw(self):
+        h, w    = self.scr.getmaxyx()
+        header  = self.header_lines()
+        ## header lines are chained into one run of text, the process lines are one cell per column
+        lines   = []
+        for parts in header:
+            x, cells = 0, []
+            for (text, attr) in parts:
+                cells.append((x, text, attr))
+                x += len(text)
+            lines.append(cells)
+        lines.append([(c.x, c.title, curses.A_BOLD) for c in self.columns])
+
+        body    = max(h - len(lines), 0)
+        rows    = self.sorted_rows()
+        self.top = max(min(self.top, len(rows) - body), 0)
+        for row in rows[self.top:self.top + body]:
+            attr = curses.A_BOLD if self.seen is not None and row['id'] not in self.seen else 0
+            lines.append([(c.x, c.fmt.format(row[c.field]), attr) for c in self.columns])
+
+        for (y, cells) in enumerate(lines[:h]):
+            prev = self.drawn.get(y, ())
+            for (i, cell) in enumerate(cells):
+                if i < len(prev) and prev[i] == cell:
+                    continue
+                self.put(y, cell, cells[i + 1][0] if i + 1 < len(cells) else w, w)
+            if len(prev) > len(cells):
+                ## the old line had more to it, clear what's left
+                self.clear_from(y, cells[-1][0] + len(cells[-1][1]), w)
+            self.drawn[y] = cells
+        for y in [y for y in self.drawn if y >= len(lines) or y >= h]:
+            self.clear_from(y, 0, w)
+            del self.drawn[y]
+
+        self.scr.noutrefresh()
+        curses.doupdate()
+
+    def put(self, y, cell, end, w):
+        (x, text, attr) = cell
+        ## pad to the next cell so whatever was there before is overwritten, never touch the last column of the screen
+        width = min(end, w - 1) - x
+        if width <= 0:
+            return
+        ## a query's newlines and tabs would move the cursor, and the rest of the line with it
+        text = self.unprintable.sub(' ', text)
+        try:
+            self.scr.addstr(y, x, text.ljust(width)[:width], attr)
+        except curses.error:
+            pass
+
+    def clear_from(self, y, x, w):
+        if x < w:
+            try:
+                self.scr.move(y, x)
+                self.scr.clrtoeol()
+            except curses.error:
+                pass
+
+    def redraw(self):
+        self.drawn = {}
+        self.scr.erase()
+        self.draw()
+
+    def key(self, ch):
+        h, w = self.scr.getmaxyx()
+        if ch in (ord('q'), ord('Q')):
+            sys.exit(0)
+        elif ch == ord('0'):
+            self.sort_col = None
+        elif ord('1') <= ch < ord('1') + len(self.columns):
+            col = ch - ord('1')
+            if col == self.sort_col:
+                self.sort_desc = not self.sort_desc
+            else:
+                self.sort_col   = col
+                ## the numbers are most interesting biggest first
+                self.sort_desc  = self.columns[col].numeric
+        elif ch == curses.KEY_DOWN:
+            self.top += 1
+        elif ch == curses.KEY_UP:
+            self.top -= 1
+        elif ch == curses.KEY_NPAGE:
+            self.top += h // 2
+        elif ch == curses.KEY_PPAGE:
+            self.top -= h // 2
+        elif ch == curses.KEY_RESIZE:
+            return self.redraw()
+        else:
+            return
+        self.draw()
+
+    def wait(self, seconds):
+        if not self.scr:
+            return time.sleep(seconds)
+        ## sleep on the keyboard rather than time.sleep(), so sorting and scrolling happen straight away
+        until = time.time() + seconds
+        while 1:
+            left = until - time.time()
+            if left <= 0:
+                return
+            self.scr.timeout(max(int(left * 1000), 1))
+            ch = self.scr.getch()
+            if ch != -1:
+                self.key(ch)
+
+## name, type, help. The num_ stats from process_row() go in as they are, minus the num_.
+METRICS = (
+    ('up',                          'gauge',    'Whether the last poll of the server worked.'),
+    ('threads_connected',           'gauge',    'Threads_connected.'),
+    ('max_connections',             'gauge',    'max_connections.'),
+) + tuple((k[4:], 'gauge', 'Matching processes counted as {0} by mypsl.'.format(k[4:].replace('_', ' '))) for k in STAT_KEYS) + (
+    ('user_processes',              'gauge',    'Matching processes per user.'),
+    ('fingerprint_processes',       'gauge',    'Matching processes per statement fingerprint.'),
+    ('fingerprint_time_seconds',    'gauge',    'Summed TIME of the matching processes per statement fingerprint.'),
+    ('fingerprint_max_time_seconds','gauge',    'Longest TIME of the matching processes per statement fingerprint.'),
+    ('last_poll_timestamp_seconds', 'gauge',    'When the server was last polled.'),
+    ('reconnects_total',            'counter',  'Times mypsl has had to reconnect to the server.'),
+    ('disconnected_seconds_total',  'counter',  'Time mypsl has spent disconnected from the server.'),
+    ('stage_seconds',               'gauge',    'Rolling p50/p95/max of the time mypsl spends per tick in each stage.'),
+)
+METRICS_FINGERPRINTS    = 20
+METRICS_LABEL_LENGTH    = 200
+
+def metrics_server(addr, metrics):
+    ## only the exporter needs an http server, so it isn't imported until then
+    try:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+
+    class metrics_handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            ## whatever the last tick left, scrapes never wait on the database
+            payload = metrics.payload
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *a):
+            pass
+
+    class threaded_server(ThreadingMixIn, HTTPServer):
+        daemon_threads      = True
+        allow_reuse_address = True
+
+    return threaded_server(addr, metrics_handler)
+
+class metrics_output():
+    '''
+        Prometheus exporter. Each tick's stats, per user and per fingerprint counts are rendered into
+        the exposition text once, and /metrics hands back that payload as is.
+    '''
+    machine     = True
+    live        = True
+    payload     = b''
+    samples     = None      ## metric -> [(labels, value)] for the tick being collected
+    fps         = None      ## server -> fingerprint_stats
+    top         = METRICS_FINGERPRINTS
+
+    def __init__(self):
+        self.samples    = defaultdict(list)
+        self.fps        = {}
+
+    def serve(self, listen):
+        (addr, _, port) = listen.rpartition(':')
+        server          = metrics_server((addr or '127.0.0.1', int(port)), self)
+        t               = threading.Thread(target=server.serve_forever, name='mypsl-metrics')
+        t.daemon        = True
+        t.start()
+
+    def add(self, name, value, **labels):
+        self.samples[name].append((labels, value))
+
+    def row(self, snap, row):
+        fps = self.fps.get(snap.label or snap.host)
+        if fps is None:
+            fps = self.fps[snap.label or snap.host] = fingerprint_stats()
+        fps.add(row)
+
+    def summary(self, snap, nums):
+        ## the watcher's label with --hosts/--config_dir, it's all error() has when a server can't be reached,
+        ## and mypsl_up has to be the same series whether the poll worked or not.
+        server = snap.label or snap.host
+        self.add('up', 1, server=server)
+        self.add('threads_connected', snap.connected_threads, server=server)
+        self.add('max_connections', snap.max_connections, server=server)
+        self.add('last_poll_timestamp_seconds', snap.taken, server=server)
+        self.add('reconnects_total', snap.reconnects, server=server)
+        self.add('disconnected_seconds_total', snap.disconnected, server=server)
+        for k in STAT_KEYS:
+            ## nothing found is a real zero, not a missing series
+            self.add(k[4:], nums[k] if nums else 0, server=server)
+        if not nums:
+            return
+        for (user, count) in nums['user_count'].items():
+            self.add('user_processes', count, server=server, user=user)
+        fps = self.fps.pop(server, None)
+        if fps:
+            for (fp_id, (fp, count, total, longest)) in fps.top(self.top):
+                labels = {'server': server, 'fingerprint': fp_id, 'query': fp[:METRICS_LABEL_LENGTH]}
+                self.add('fingerprint_processes', count, **labels)
+                self.add('fingerprint_time_seconds', total, **labels)
+                self.add('fingerprint_max_time_seconds', longest, **labels)
+
+    def error(self, label, err):
+        self.add('up', 0, server=label)
+
+    def timings(self, tick):
+        pass
+
+    def flush(self):
+        for k in stage_timings.stages:
+            for (q, v) in zip(('0.5', '0.95', '1'), TIMINGS.percentiles(k)):
+                self.add('stage_seconds', v, stage=k, quantile=q)
+        out = []
+        for (name, kind, help_text) in METRICS:
+            if name not in self.samples:
+                continue
+            out.append("# HELP mypsl_{0} {1}\n# TYPE mypsl_{0} {2}\n".format(name, help_text, kind))
+            for (labels, value) in self.samples[name]:
+                out.append("mypsl_{0}{{{1}}} {2}\n".format(name,
+                    ','.join('{0}="{1}"'.format(k, escape_label(v)) for (k, v) in sorted(labels.items())), value))
+        ## swapping the reference is all the locking the scrape threads need
+        self.payload = ''.join(out).encode('utf-8')
+        self.samples = defaultdict(list)
+        self.fps     = {}
+
+    def wait(self, seconds):
+        time.sleep(seconds)
+
+def escape_label(val):
+    return "{0}".format(val).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def get_output(fmt):
+    if fmt == 'text':
+        return text_output()
+    if fmt == 'tui':
+        return tui_output()
+    if fmt == 'prometheus':
+        return metrics_output()
+    return record_output(fmt)
+
+def counts_sleepers():
+    ## the state field would be 'User sleep', so is 'sleep' found in the state argument given ?
+    ## if not, the sleepers were filtered out and the count comes from the server's status instead.
+    return any(c.lower() == 'sleep' for c in args.command or ()) or any('sleep' in st.lower() for st in args.state or ())
+
+def process_row(snap, hist=None, fps=None):
     if not args.id_only:
-        num_reads           = num_writes = num_locked = num_closing = num_opening = num_past_long_query = num_sleepers = 0
+        num_processes       = num_reads = num_writes = num_locked = num_closing = num_opening = num_past_long_query = num_sleepers = nbytes = 0
         user_count          = defaultdict(int)
 
-    ## the state field would be 'User sleep', so is 'sleep' found in the state argument given ?
-    if (args.command and args.command.lower() == 'sleep') or (args.state and 'sleep' in args.state.lower()):
-        calculate_sleepers = True
-    
+    calculate_sleepers = counts_sleepers()
     if not calculate_sleepers:
-        num_sleepers = get_num_sleepers()
+        num_sleepers = snap.num_sleepers
 
-    for row in results:
+    for row in snap.rows:
         if args.id_only:
             print(row['id'])
             continue
 
+        num_processes += 1
         user_count[row['user']] += 1
         
         if row['info']:
-            ## pull the first word of the query out - newline, tab or whitespace, and lowercase it.
-            s_info = row['info'].split()[0].lower()
-            if args.trim_info and len(row['info']) > 1000:
-                row['info'] = "%s ..." % row['info'][:1000]
+            s_info = get_keyword(row)
+            if args.trim_info and row.get('info_length', len(row['info'])) > INFO_TRIM_LENGTH:
+                row['info'] = "%s ..." % row['info'][:INFO_TRIM_LENGTH]
         else:
             row['info'] = '--'
             s_info = '--'
@@ -492,11 +3033,19 @@ def process_row(results):
             if row['state'].startswith('Opening table'):        num_opening += 1
             if row['state'].startswith('closing table'):        num_closing += 1
 
-        if int(row['time']) > LONG_QUERY_TIME: num_past_long_query += 1
+        if int(row['time']) > snap.long_query_time: num_past_long_query += 1
 
         if calculate_sleepers and ('sleep' in row['command'].lower()) or ('sleep' in row['state'].lower()):
             num_sleepers += 1
 
+        if hist:
+            hist.observe(row, snap.taken)
+        if fps:
+            fps.add(row)
+        if args.timings:
+            ## roughly what came over the wire for the row, only worked out when asked for
+            nbytes += sum(len("{0}".format(v)) for v in row.values())
+
         #print("id: %s" % row['id'])
         #print("user: %s" % row['user'])
         #print("host: %s" % row['host'])
@@ -506,12 +3055,15 @@ def process_row(results):
         #print("state: %s" % row['state'])
         #print("info: %s" % row['info'])
 
-        print(OUT_FORMAT.format(row['id'], row['user'], row['host'], row['db'], row['command'], row['time'], row['state'], row['info']))
+        OUTPUT.row(snap, row)
 
     if args.id_only:
         return
 
+    TIMINGS.add('rows', num_processes)
+    TIMINGS.add('bytes', nbytes)
     return {
+        'num_processes':        num_processes,
         'num_reads':            num_reads,
         'num_writes':           num_writes,
         'num_locked':           num_locked,
@@ -522,89 +3074,672 @@ def process_row(results):
         'user_count':           user_count
     }
 
-def pslist(sql, counter=0):
-    start = time.time()
-    cur = db.query(sql)
-    res = cur.fetchall()
-    
-    if res:
-        num_processes       = cur.rowcount
+def stats_row(snap):
+    '''
+        --stats: adds up the per user rows the server sent back into what process_row() returns.
+    '''
+    nums        = dict((k, 0) for k in STAT_KEYS)
+    user_count  = defaultdict(int)
+    for row in snap.rows:
+        for k in STAT_KEYS:
+            nums[k] += int(row[k] or 0)
+        user_count[row['user']] += int(row['num_processes'])
+
+    if not counts_sleepers():
+        nums['num_sleepers'] = snap.num_sleepers
+    nums['user_count'] = user_count
+    TIMINGS.add('rows', nums['num_processes'])
+    return nums
+
+def show_queries_sent(queries_start, conn=None):
+    conn = conn or db
+    print("\t({0}): {1}".format(color_val('Queries sent', Fore.GREEN), color_val(conn.num_queries - queries_start, Fore.CYAN)), file=sys.stderr)
+
+def print_kills(snap, report):
+    ## keep stdout parseable when it's records, the kill log is the machine readable side of kills.
+    out      = sys.stderr if OUTPUT.machine else sys.stdout
+    criteria = [c for c in (USER_WHERE, args.kill_roots and "root blocker of {0}+".format(args.kill_roots),
+        args.kill_policy and "policy {0}".format(args.kill_policy),
+        args.kill_fingerprint and "fingerprint {0}".format(args.kill_fingerprint)) if c]
+    print("{0}".format(color_val(get_now_date() + " :: " + snap.host + \
+        " :: Killed: " + str(report.killed) + " (WHERE {0})".format(' AND '.join(criteria)), Fore.RED + Style.BRIGHT)), file=out)
+    print("\t({0}) {1}".format(color_val("Kills", Fore.GREEN), report), file=out)
+
+def print_stats(snap, _nums):
+    num_processes       = _nums['num_processes']
+    num_reads           = _nums['num_reads']
+    num_writes          = _nums['num_writes']
+    num_locked          = _nums['num_locked']
+    num_closing         = _nums['num_closing']
+    num_opening         = _nums['num_opening']
+    num_sleepers        = _nums['num_sleepers']
+    num_past_long_query = _nums['num_past_long_query']
+
+    ## format total processes
+    if num_processes >= PROCESS_THRESHOLD_CRIT:
+        num_processes = color_val(num_processes, Fore.RED)
+    elif num_processes >= PROCESS_THRESHOLD_WARN:
+        num_processes = color_val(num_processes, Fore.YELLOW)
+    else:
+        num_processes = color_val(num_processes, Fore.CYAN)
+
+    ## format the number of queries past the long query time
+    if num_past_long_query > 0:
+        num_past_long_query = color_val(num_past_long_query, Fore.RED)
+    else:
+        num_past_long_query = color_val(num_past_long_query, Fore.CYAN)
+
+    ## format the number of sleepers
+    if num_sleepers >= SLEEPER_THRESHOLD_CRIT:
+        num_sleepers = color_val(num_sleepers, Fore.RED)
+    elif num_sleepers >= SLEEPER_THRESHOLD_WARN:
+        num_sleepers = color_val(num_sleepers, Fore.YELLOW)
+    else:
+        num_sleepers = color_val(num_sleepers, Fore.CYAN)
+
+    print("\t({0}) PROCESSES: {1}, SLEEPERS: {2}, LOCKED: {3}, READS: {4}, WRITES: {5}, CLOSING: {6}, OPENING: {7}, PAST LQT: {8}"
+        .format(color_val(snap.host, Fore.GREEN), num_processes, num_sleepers, color_val(num_locked, Fore.CYAN), 
+            color_val(num_reads, Fore.CYAN), color_val(num_writes, Fore.CYAN), color_val(num_closing, Fore.CYAN), 
+            color_val(num_opening, Fore.CYAN), num_past_long_query))
+    if snap.reconnects:
+        print("\t({0}) {1}, disconnected for {2}s in all".format(color_val("Reconnects", Fore.GREEN),
+            color_val(snap.reconnects, Fore.YELLOW), color_val(round(snap.disconnected, 3), Fore.YELLOW)))
+
+def print_users(user_count):
+    ## this is ok, but the next one sorts by occurrence
+    #mystr = "{0}".format( ', '.join("%s: %s" % (k, "{0}".format(color_val(v, Fore.CYAN))) for (k, v) in user_count.iteritems()) )
+    user_str = "{0}".format( ', '.join("%s: %s" % (k, "{0}".format(color_val(user_count[k], Fore.CYAN))) \
+        for k in sorted(user_count, key=user_count.get, reverse=True)) )
+
+    print("\t({0}) {1}".format(color_val("Users", Fore.GREEN), user_str))
+
+def pslist(query, counter=0, snap=None):
+    start           = time.time()
+    queries_start   = db.num_queries
+    snap            = snap or take_snapshot(query)
+
+    if snap.rows or (args.kill_roots and snap.locks and snap.locks.roots):
         if args.kill:
-            kills = killah(res)
+            kills = killah(snap)
             if kills:
-                user_where_str = ' AND '.join(USER_WHERE)
-                print("{0}".format(color_val(get_now_date() + " :: " + get_hostname() + \
-                    " :: Killed: " + str(kills) + " (WHERE {0})".format(user_where_str), Fore.RED + Style.BRIGHT)))
+                print_kills(snap, kills)
+            if args.debug:
+                show_queries_sent(queries_start)
             return
 
-        if not args.id_only:
-            print_header()
+        hist                = db.get_history() if args.history else None
+        fps                 = fingerprint_stats() if args.fingerprints else None
+        processing          = time.time()
+        _nums               = stats_row(snap) if args.stats else process_row(snap, hist, fps)
+        rendering           = time.time()
+        if SCHEDULER:
+            SCHEDULER.observe(_nums)
+        TIMINGS.add('process', rendering - processing)
 
-        _nums               = process_row(res)
+        ## the rows are only written out by OUTPUT.flush() (or a --stream buffer's worth at a time), so the header can still
+        ## go above them, and with --locks it has to wait for the process list to be read before it can ask about the blockers.
+        if not args.id_only and not OUTPUT.machine:
+            OUTPUT.header(snap)
 
         if args.id_only:
             ## then we're done here.
             return True
 
-        num_reads           = _nums['num_reads']
-        num_writes          = _nums['num_writes']
-        num_locked          = _nums['num_locked']
-        num_closing         = _nums['num_closing']
-        num_opening         = _nums['num_opening']
-        num_sleepers        = _nums['num_sleepers']
-        num_past_long_query = _nums['num_past_long_query']
-        user_count          = _nums['user_count']
-
-        ## format total processes
-        if num_processes >= PROCESS_THRESHOLD_CRIT:
-            num_processes = color_val(num_processes, Fore.RED)
-        elif num_processes >= PROCESS_THRESHOLD_WARN:
-            num_processes = color_val(num_processes, Fore.YELLOW)
-        else:
-            num_processes = color_val(num_processes, Fore.CYAN)
-
-        ## format the number of queries past the long query time
-        if num_past_long_query > 0:
-            num_past_long_query = color_val(num_past_long_query, Fore.RED)
-        else:
-            num_past_long_query = color_val(num_past_long_query, Fore.CYAN)
-
-        ## format the number of sleepers
-        if num_sleepers >= SLEEPER_THRESHOLD_CRIT:
-            num_sleepers = color_val(num_sleepers, Fore.RED)
-        elif num_sleepers >= SLEEPER_THRESHOLD_WARN:
-            num_sleepers = color_val(num_sleepers, Fore.YELLOW)
-        else:
-            num_sleepers = color_val(num_sleepers, Fore.CYAN)
-
-        print("\n\t({0}) PROCESSES: {1}, SLEEPERS: {2}, LOCKED: {3}, READS: {4}, WRITES: {5}, CLOSING: {6}, OPENING: {7}, PAST LQT: {8}"
-            .format(color_val(get_hostname(), Fore.GREEN), num_processes, num_sleepers, color_val(num_locked, Fore.CYAN), 
-                color_val(num_reads, Fore.CYAN), color_val(num_writes, Fore.CYAN), color_val(num_closing, Fore.CYAN), 
-                color_val(num_opening, Fore.CYAN), num_past_long_query))
-
-        ## this is ok, but the next one sorts by occurrence
-        #mystr = "{0}".format( ', '.join("%s: %s" % (k, "{0}".format(color_val(v, Fore.CYAN))) for (k, v) in user_count.iteritems()) )
-        user_str = "{0}".format( ', '.join("%s: %s" % (k, "{0}".format(color_val(user_count[k], Fore.CYAN))) \
-            for k in sorted(user_count, key=user_count.get, reverse=True)) )
+        if OUTPUT.machine:
+            if hist:
+                hist.end_tick(_nums, snap.taken)
+            OUTPUT.summary(snap, _nums)
+            if args.timings:
+                OUTPUT.timings(dict(TIMINGS.tick, total=time.time() - start))
+            OUTPUT.flush()
+            TIMINGS.add('render', time.time() - rendering)
+            return True
 
-        print("\t({0}) {1}".format(color_val("Users", Fore.GREEN), user_str))
+        OUTPUT.flush()
+        print()
+        print_stats(snap, _nums)
+        print_users(_nums['user_count'])
+        if hist:
+            hist.end_tick(_nums, snap.taken)
+            print_history(hist)
+        if fps:
+            print_fingerprints(fps, args.fingerprints)
+        TIMINGS.add('render', time.time() - rendering)
         show_processing_time(start, time.time())
+        if args.timings:
+            OUTPUT.timings(dict(TIMINGS.tick, total=time.time() - start))
+        if args.debug:
+            show_queries_sent(queries_start)
         print()
         return True
     else:
+        if args.history:
+            ## everything we were tracking has finished
+            db.get_history().end_tick(None, snap.taken)
+
+        if OUTPUT.machine:
+            OUTPUT.summary(snap, None)
+            OUTPUT.flush()
+            return False
+
         ## just sending a message to the terminal to let the user that the script is still working, and isn't stuck.
         if counter % 4 == 0:
-            print(color_val("{0} :: ({1}) :: Still looking...".format(get_now_date(), get_hostname()), Style.BRIGHT), file=sys.stderr)
+            print(color_val("{0} :: ({1}) :: Still looking...".format(get_now_date(), snap.host), Style.BRIGHT), file=sys.stderr)
+        if args.debug:
+            show_queries_sent(queries_start)
         return False
 
-def main():
+class host_watcher():
+    '''
+        One host of a multi-host watch. Each has its own connection, source and query,
+        since each server may support a different process list source.
+    '''
+    conn    = None
+    source  = None
+    query   = None
+    label   = None
+    nums    = None
+    fps     = None
+
+    def __init__(self, conn, label):
+        self.conn           = conn
+        self.label          = label
+        conn.label          = label
+        conn.exit_on_error  = False
+
+    def poll(self):
+        ## runs in a pool thread, everything it needs is returned rather than printed.
+        start = time.time()
+        try:
+            if not self.query:
+                self.source = get_process_source(args.source, self.conn)
+                self.query  = build_query(self.source)
+            snap    = take_snapshot(self.query, self.conn)
+            kills   = killah(snap, self.conn) if args.kill and (snap.rows or (args.kill_roots and snap.locks and snap.locks.roots)) else 0
+            return (snap, kills, None, time.time() - start)
+        except pymysql.Error as e:
+            return (None, 0, e, time.time() - start)
+
+def get_host_conns():
+    ## (label, connection) for each of --config_dir and --hosts
+    conns = []
+    if args.config_dir:
+        for f in sorted(next(os.walk(args.config_dir))[2]):
+            conns.append((f, mydb(config_file=os.path.join(args.config_dir, f))))
+    if args.hosts:
+        for h in args.hosts.split(','):
+            host, _, port = h.strip().partition(':')
+            conns.append((h.strip(), mydb(host=host, port=int(port) if port else None)))
+    return conns
+
+def get_host_watchers():
+    return [host_watcher(conn, label) for (label, conn) in get_host_conns()]
+
+def pslist_exporter(query, counter=0):
+    ## single-host --format prometheus, where a failed tick is mypsl_up 0 and the next one tries again
+    try:
+        return pslist(query, counter)
+    except pymysql.Error as e:
+        if db.conn:
+            ## connected but the tick failed anyway (privileges, say). Not being connected has been reported already.
+            print("({0}) ERROR: {1}".format(db.label, e), file=sys.stderr)
+        OUTPUT.error(db.label, e)
+        OUTPUT.flush()
+        return False
+
+def pslist_hosts(watchers, pool, counter=0):
+    start   = time.time()
+    results = pool.map(host_watcher.poll, watchers)
+    found   = False
+
+    for w, (snap, kills, err, elapsed) in zip(watchers, results):
+        if snap and snap.rows and not args.kill:
+            found = True
+            w.fps  = fingerprint_stats() if args.fingerprints else None
+            processing = time.time()
+            w.nums = stats_row(snap) if args.stats else process_row(snap, w.conn.get_history() if args.history else None, w.fps)
+            TIMINGS.add('process', time.time() - processing)
+            if SCHEDULER:
+                SCHEDULER.observe(w.nums)
+            if not OUTPUT.machine and not args.stats:
+                OUTPUT.header(snap)
+            if OUTPUT.machine:
+                OUTPUT.summary(snap, w.nums)
+            elif not args.stats:
+                OUTPUT.flush()
+                print()
+
+    if OUTPUT.machine:
+        for w, (snap, kills, err, elapsed) in zip(watchers, results):
+            if err:
+                OUTPUT.error(w.label, err)
+            elif not (snap.rows and not args.kill):
+                ## with --kill the rows weren't counted, so only a live view gets a summary of those
+                if OUTPUT.live or not snap.rows:
+                    OUTPUT.summary(snap, None)
+                if args.history:
+                    w.conn.get_history().end_tick(None, snap.taken)
+            elif args.history:
+                w.conn.get_history().end_tick(w.nums, snap.taken)
+        if args.timings:
+            OUTPUT.timings(dict(TIMINGS.tick, total=time.time() - start))
+        OUTPUT.flush()
+        return found
+
+    ## the dashboard: one stats line per host, so the whole fleet fits on a screen.
+    print("{0}{1}{2} Hosts: {3} :: {4} {5}{1}{6}".format(Fore.YELLOW, "-"*35, Fore.GREEN, len(watchers), get_now_date(), Fore.YELLOW, Fore.RESET))
+    for w, (snap, kills, err, elapsed) in zip(watchers, results):
+        if err:
+            print("\t({0}) {1}".format(color_val(w.label, Fore.RED), color_val("ERROR: {0}".format(err), Fore.RED + Style.BRIGHT)))
+        elif kills:
+            found = True
+            print_kills(snap, kills)
+        elif snap.rows and not args.kill:
+            print_stats(snap, w.nums)
+            if args.history:
+                w.conn.get_history().end_tick(w.nums, snap.taken)
+                print_history(w.conn.get_history())
+            if w.fps:
+                print_fingerprints(w.fps, args.fingerprints)
+        else:
+            print("\t({0}) {1}".format(color_val(snap.host, Fore.GREEN), color_val("Nothing found", Style.BRIGHT)))
+            if args.history:
+                w.conn.get_history().end_tick(None, snap.taken)
+        if args.debug:
+            show_processing_time(0, elapsed, snap.host if snap else w.label)
+
+    show_processing_time(start, time.time())
+    if args.timings:
+        OUTPUT.timings(dict(TIMINGS.tick, total=time.time() - start))
+    print()
+    return found
+
+## --replication: the status columns we care about, under each name they've gone by (8.0.22 renamed them, MariaDB has its own).
+REPLICA_FIELDS = (
+    ('channel',     ('Channel_Name', 'Connection_name')),
+    ('source',      ('Source_Host', 'Master_Host')),
+    ('io',          ('Replica_IO_Running', 'Slave_IO_Running')),
+    ('sql',         ('Replica_SQL_Running', 'Slave_SQL_Running')),
+    ('lag',         ('Seconds_Behind_Source', 'Seconds_Behind_Master')),
+    ('error',       ('Last_Error', 'Last_SQL_Error', 'Last_IO_Error')),
+)
+SKIP_REPLICATION_CHECK_FILE = '/tmp/skip-replication-check'
+INSTANCE_METADATA_URL       = 'http://169.254.169.254/latest/meta-data/'
+INSTANCE_METADATA           = (('Public IP', 'public-ipv4'), ('Private IP', 'local-ipv4'), ('Public Hostname', 'public-hostname'))
+
+def replica_status_sql(conn):
+    ## the version comes from the metadata cache, so this doesn't cost a query once it's known
+    version = get_metadata('version', conn) or ''
+    if conn.meta.flavor == 'MariaDB':
+        ## every connection of a multi-source replica, not just the default one
+        return 'SHOW ALL SLAVES STATUS'
+    if tuple(int(v) for v in re.findall(r'\d+', version)[:3]) >= (8, 0, 22):
+        return 'SHOW REPLICA STATUS'
+    return 'SHOW SLAVE STATUS'
+
+def replica_field(row, names):
+    ## the first of names with something in it. A lag of 0 is something, so don't go by truth.
+    for n in names:
+        if row.get(n) not in (None, ''):
+            return row[n]
+    return None
+
+class replica_channel():
+    '''
+        One replication channel on one replica: its last status, and the lag samples for the last --repl_window seconds.
+        lagging_since is when the lag last went over --repl_lag without coming back under, so a sustained
+        lag is a check of one value rather than going through the samples.
+    '''
+    status          = {}
+    samples         = None
+    lagging_since   = None
+
+    def __init__(self):
+        self.status     = {}
+        self.samples    = deque()
+
+    def observe(self, status, now):
+        self.status = status
+        lag         = status['lag']
+        self.samples.append((now, lag))
+        while self.samples and self.samples[0][0] < now - args.repl_window:
+            self.samples.popleft()
+
+        if lag is None or lag < args.repl_lag:
+            self.lagging_since = None
+        elif self.lagging_since is None:
+            self.lagging_since = now
+
+    @property
+    def running(self):
+        return all(str(self.status.get(k) or '').lower() == 'yes' for k in ('io', 'sql'))
+
+    def sustained(self, now):
+        return self.lagging_since is not None and now - self.lagging_since >= args.repl_window
+
+    def window(self):
+        lags = [l for (t, l) in self.samples if l is not None]
+        if not lags:
+            return None
+        return (min(lags), sum(lags) / float(len(lags)), max(lags))
+
+class replica_watcher():
+    '''
+        One replica for --replication. The connection is kept open between checks, and each check is the one
+        SHOW ... STATUS (the version it depends on is cached), whatever the number of channels.
+    '''
+    conn        = None
+    label       = None
+    channels    = {}
+
+    def __init__(self, conn, label):
+        self.conn           = conn
+        self.label          = label
+        self.channels       = {}
+        conn.exit_on_error  = False
+
+    def poll(self):
+        ## runs in a pool thread
+        try:
+            cur     = self.conn.query(replica_status_sql(self.conn))
+            rows    = cur.fetchall()
+            return ([dict((k, replica_field(r, names)) for (k, names) in REPLICA_FIELDS) for r in rows], None)
+        except pymysql.Error as e:
+            return (None, e)
+
+class replication_alerts():
+    '''
+        Alerts for --replication, one per (replica, channel, problem) for as long as the problem lasts.
+        It's sent again every --repl_realert seconds while it goes on, and once more when it clears.
+    '''
+    active  = {}
+    meta    = None
+
+    def __init__(self):
+        self.active = {}
+
+    def fire(self, key, subject, message, now):
+        last = self.active.get(key)
+        if last is not None and now - last < args.repl_realert:
+            return
+        self.active[key] = now
+        self.send(key, subject if last is None else "{0} (still)".format(subject), message)
+
+    def clear(self, key, subject, message):
+        if self.active.pop(key, None) is not None:
+            self.send(key, subject, message)
+
+    def send(self, key, subject, message):
+        subject = "[{0}] - Replication :: {1} :: {2}".format(args.repl_deployment, key[0] + (' ' + key[1] if key[1] else ''), subject)
+        if OUTPUT.machine:
+            print(json.dumps({'type': 'alert', 'date': get_now_date(), 'replica': key[0], 'channel': key[1], 'problem': key[2],
+                'subject': subject, 'message': message}, default=str, separators=(',', ':')))
+        else:
+            print(color_val("{0} :: {1}".format(get_now_date(), subject), Fore.RED + Style.BRIGHT))
+            print("\t{0}".format(message.replace('\n', '\n\t')))
+        sys.stdout.flush()
+        if args.repl_email:
+            self.email(subject, message)
+
+    def instance_metadata(self):
+        ## the instance doesn't move, so this is looked up for the first email only
+        if self.meta is None:
+            try:
+                from urllib.request import urlopen
+            except ImportError:
+                from urllib2 import urlopen
+            self.meta = [('Hostname', gethostname())]
+            for (title, path) in INSTANCE_METADATA:
+                try:
+                    self.meta.append((title, urlopen(INSTANCE_METADATA_URL + path, timeout=1).read().decode('utf-8')))
+                except Exception:
+                    break
+        return self.meta
+
+    def email(self, subject, message):
+        import subprocess
+        body = "To: {0}\nSubject: {1}\n\n{2}\n\n{3}\nDate Checked: {4}\n".format(args.repl_email, subject, message,
+            '\n'.join("{0}: {1}".format(*m) for m in self.instance_metadata()), get_now_date())
+        try:
+            proc = subprocess.Popen(['mail', '-t'], stdin=subprocess.PIPE)
+            proc.communicate(body.encode('utf-8'))
+        except OSError as e:
+            print(color_val("Unable to send the alert email: {0}".format(e), Fore.RED + Style.BRIGHT), file=sys.stderr)
+
+def check_replica(w, rows, err, alerts, now):
+    if err:
+        alerts.fire((w.label, '', 'unreachable'), "Unreachable!", "Unable to check replication: {0}".format(err), now)
+        return
+    alerts.clear((w.label, '', 'unreachable'), "Reachable again", "Replication can be checked again.")
+
+    seen = set()
+    for status in rows:
+        name = status['channel'] or ''
+        seen.add(name)
+        ch = w.channels.get(name)
+        if ch is None:
+            ch = w.channels[name] = replica_channel()
+        ch.observe(status, now)
+
+        if ch.running:
+            alerts.clear((w.label, name, 'down'), "Replication running", "Replication is running again.")
+        else:
+            alerts.fire((w.label, name, 'down'), "Replication Down!",
+                "Replication is not running!\n\nIO_Running: {io}\nSQL_Running: {sql}\nLast_Error: {error}".format(**status), now)
+
+        if ch.sustained(now):
+            alerts.fire((w.label, name, 'lag'), "Replication Behind",
+                "Replication has been more than {0}s behind the source for {1}s.\n\nSeconds Behind: {2} (min/avg/max {3}/{4:.1f}/{5})".format(
+                    args.repl_lag, int(now - ch.lagging_since), status['lag'], *ch.window()), now)
+        elif ch.lagging_since is None:
+            alerts.clear((w.label, name, 'lag'), "Replication caught up", "Replication is {0}s behind the source.".format(status['lag']))
+
+    for name in [n for n in w.channels if n not in seen]:
+        ## a channel that's been reset, or a replica that isn't one any more
+        del w.channels[name]
+        for problem in ('down', 'lag'):
+            alerts.active.pop((w.label, name, problem), None)
+
+def print_replicas(watchers):
+    if OUTPUT.machine:
+        for w in watchers:
+            for (name, ch) in sorted(w.channels.items()):
+                window = ch.window() or (None, None, None)
+                print(json.dumps({'type': 'replication', 'date': get_now_date(), 'replica': w.label, 'channel': name,
+                    'source': ch.status['source'], 'io': ch.status['io'], 'sql': ch.status['sql'], 'lag': ch.status['lag'],
+                    'lag_min': window[0], 'lag_avg': window[1], 'lag_max': window[2]}, default=str, separators=(',', ':')))
+        sys.stdout.flush()
+        return
+
+    print("{0}{1}{2} Replicas: {3} :: {4} {5}{1}{6}".format(Fore.YELLOW, "-"*35, Fore.GREEN, len(watchers), get_now_date(), Fore.YELLOW, Fore.RESET))
+    for w in watchers:
+        if not w.channels:
+            print("\t({0}) {1}".format(color_val(w.label, Fore.GREEN), color_val("Not a replica", Style.BRIGHT)))
+        for (name, ch) in sorted(w.channels.items()):
+            window  = ch.window()
+            lag     = ch.status['lag']
+            print("\t({0}) {1}IO: {2}, SQL: {3}, Behind: {4}, last {5:g}s min/avg/max: {6}".format(color_val(w.label, Fore.GREEN),
+                "{0} ".format(color_val(name, Fore.CYAN)) if name else '',
+                color_val(ch.status['io'], Fore.CYAN if ch.running else Fore.RED), color_val(ch.status['sql'], Fore.CYAN if ch.running else Fore.RED),
+                color_val(lag, Fore.RED if lag is None or lag >= args.repl_lag else Fore.CYAN), args.repl_window,
+                "{0}/{1:.1f}/{2}".format(*window) if window else '--'))
+    print()
+    sys.stdout.flush()
+
+def watch_replication():
+    '''
+        --replication: checks every replica every --replication seconds, all at once, over connections
+        that stay open, and alerts on lag that lasts rather than a single sample.
+    '''
+    watchers    = [replica_watcher(c, label) for (label, c) in get_host_conns()] if MULTI_HOST else [replica_watcher(db, db.host)]
+    conns       = lambda: [c for w in watchers for c in w.conn.connections()]
+    from multiprocessing.pool import ThreadPool
+    pool        = ThreadPool(len(watchers))
+    alerts      = replication_alerts()
+    report_at   = 0
+    schedule    = tick_scheduler(args.replication)
+
+    while 1:
+        schedule.start()
+        start   = time.time()
+        results = pool.map(replica_watcher.poll, watchers)
+        now     = time.time()
+        if os.path.exists(SKIP_REPLICATION_CHECK_FILE):
+            ## someone's working on replication, keep watching but don't alert
+            alerts.active = {}
+        else:
+            for (w, (rows, err)) in zip(watchers, results):
+                check_replica(w, rows, err, alerts, now)
+
+        if now >= report_at:
+            print_replicas(watchers)
+            report_at = now + args.repl_report
+        if args.replication <= 0:
+            return
+        TIMINGS.add('total', time.time() - start)
+        TIMINGS.end_tick()
+        idle(schedule.next(), conns)
+
+def build_query(source):
     global USER_WHERE
-    where           = []
+    where           = where_builder(source)
     order_by        = []
     where_str       = ''
     order_by_str    = ''
+    group_by_str    = ''
     select_fields   = ['id']
+    computed        = ()
+
+    if args.stats:
+        ## a row per user, with the counts in it. The user expression is grouped on, rather than the alias,
+        ## since GROUP BY looks for table columns before aliases.
+        sql = source.select_sql(['user'], STATS_SQL)
+    elif not args.id_only:
+        select_fields.extend(PROCESS_FIELDS[1:])
+        ## killing doesn't print the queries, and the ones we do kill get their full text fetched for the log.
+        if args.trim_info or args.kill:
+            select_fields.remove('info')
+            computed = TRIMMED_INFO
+
+    if not args.stats:
+        sql = source.select_sql(select_fields, computed)
+
+    if args.default:
+        where.add("({command} = 'Query' OR {command} = 'Connect')")
+        order_by = ['time ASC', 'id ASC']
+    else:
+        if args.command:
+            where.any_of('command', args.command)
+        if args.state:
+            where.any_of('state', args.state)
+        if args.time:
+            where.add("{time} >= %s", args.time)
+        if args.max_time is not None:
+            where.add("{time} <= %s", args.max_time)
+        if args.database:
+            where.any_of('db', args.database)
+        if args.match_user:
+            where.any_of('user', args.match_user)
+        if args.match_host:
+            where.add("{host} LIKE %s", args.match_host + '%')
+        if args.query:
+            where.add("{info} LIKE %s", args.query + '%')
+        if args.query_regex:
+            where.add("{info} REGEXP %s", args.query_regex)
+        if args.order_by:
+            order_by.append(args.order_by)
+        USER_WHERE = where.display()
+
+    where.add("{command} != 'Binlog Dump'")
+    where.add("({db} != 'information_schema' OR {db} IS NULL)") ## confuses me why I had to add OR db IS NULL
+    for w in source.where:
+        where.add(w)
+
+    if args.ignore_system_user == True:
+        where.add("{user} != 'system user'")
 
+    if where.clauses:
+        where_str = ' WHERE {0}'.format(where.sql())
+
+    if args.stats:
+        group_by_str = ' GROUP BY {0}'.format(source.col('user'))
+    elif order_by:
+        order_by_str = ' ORDER BY {0}'.format(', '.join(order_by))
+
+    return process_query(''.join([sql, where_str, group_by_str, order_by_str]), where.params, source)
+
+class tick_scheduler():
+    '''
+        Keeps looping on a fixed cadence: a tick is due an interval after the last one was due, not after it finished,
+        so the time the tick took doesn't add up tick after tick. When a tick runs past when the next was due, the ticks
+        it ran over are skipped rather than run back to back to catch up, and either way it's said on stderr.
+
+        With --loop_min/--loop_max the interval adapts. It goes straight down to loop_min on a tick where processes or
+        sleepers cross their warning thresholds (on any host), and otherwise lengthens by SCHEDULE_BACKOFF each tick up to loop_max.
+    '''
+    interval    = 0
+    low         = 0
+    high        = 0
+    due         = None
+    started     = 0
+    busy        = False
+    skipped     = 0
+    late        = 0
+
+    def __init__(self, interval, low=None, high=None):
+        self.interval   = interval
+        self.low        = min(low or interval, interval)
+        self.high       = max(high or interval, interval)
+
+    def observe(self, nums):
+        ## the stats of a tick (a host's, when watching several)
+        if nums and (nums['num_processes'] >= PROCESS_THRESHOLD_WARN or nums['num_sleepers'] >= SLEEPER_THRESHOLD_WARN):
+            self.busy = True
+
+    def start(self):
+        now = monotonic()
+        if self.due is None:
+            self.due = now
+        elif now - self.due > self.interval * SCHEDULE_LATE:
+            self.late += 1
+            print(color_val("{0} :: Tick started {1}s late".format(get_now_date(), round(now - self.due, 3)), Fore.YELLOW), file=sys.stderr)
+        self.started    = now
+        self.busy       = False
+
+    def next(self):
+        ## seconds until the next tick is due
+        if self.busy:
+            self.interval = self.low
+        else:
+            self.interval = min(self.interval * SCHEDULE_BACKOFF, self.high)
+
+        now = monotonic()
+        due = self.due + self.interval
+        if now > due:
+            if now - self.started > self.interval:
+                missed = int((now - due) // self.interval) + 1
+                self.skipped += missed
+                print(color_val("{0} :: Tick took {1}s, more than the {2}s interval, skipped {3}".format(get_now_date(),
+                    round(now - self.started, 3), round(self.interval, 3), missed), Fore.YELLOW), file=sys.stderr)
+                due += missed * self.interval
+            else:
+                ## not an overrun, the interval just got shorter than the time since the last one was due
+                due = now
+        self.due = due
+        return due - now
+
+def idle(seconds, conns):
+    ## the wait between ticks, keeping the connections warm if it's a long one.
+    until = monotonic() + seconds
+    while 1:
+        left = until - monotonic()
+        if left <= 0:
+            return
+        OUTPUT.wait(min(left, KEEPALIVE_INTERVAL))
+        for c in conns():
+            c.keepalive()
+
+def main():
     if args.id_only and args.kill:
         print(color_val("ERROR: Cannot specify id only (-i, --id) with kill!", Fore.RED + Style.BRIGHT))
         sys.exit(1)
@@ -613,99 +3748,221 @@ def main():
         print(color_val("ERROR: Cannot kill using defaults!", Fore.RED + Style.BRIGHT))
         sys.exit(1)
 
-    if args.kill:
-        if not args.kill_yes:
-            ans = raw_input(color_val("Are you sure you want to kill queries? ", Style.BRIGHT))
-            if ans.lower() not in ('y', 'yes'):
-                print("Ok, then only use --kill when you are sure you want to kill stuff.")
-                sys.exit(0)
+    if args.kill and not any((args.command, args.state, args.time, args.max_time is not None, args.database, args.query,
+            args.query_regex, args.match_user, args.match_host, args.kill_fingerprint, args.kill_roots, args.kill_policy)):
+        print(color_val("ERROR: Cannot kill without specifying criteria!", Fore.RED + Style.BRIGHT))
+        sys.exit(1)
 
-    if not args.id_only:
-        select_fields.extend(['user', 'host', 'db', 'command', 'time', 'state', 'info'])
+    if args.id_only and MULTI_HOST:
+        print(color_val("ERROR: Cannot specify id only (-i, --id) with multiple hosts!", Fore.RED + Style.BRIGHT))
+        sys.exit(1)
+
+    if args.id_only and OUTPUT.machine:
+        print(color_val("ERROR: Cannot specify id only (-i, --id) with --format {0}!".format(args.format), Fore.RED + Style.BRIGHT))
+        sys.exit(1)
+
+    if args.format == 'tui' and (args.kill or args.id_only or MULTI_HOST):
+        print(color_val("ERROR: --format tui is a view of one host, it can't be used with kill, id only or multiple hosts!", Fore.RED + Style.BRIGHT))
+        sys.exit(1)
 
-    sql = "SELECT SQL_NO_CACHE {0} FROM processlist".format(', '.join(select_fields))
+    if args.format == 'prometheus' and (args.kill or args.id_only):
+        print(color_val("ERROR: --format prometheus can't be used with kill or id only!", Fore.RED + Style.BRIGHT))
+        sys.exit(1)
+
+    if args.stats and (args.kill or args.id_only or args.fingerprints or args.record or args.replay or args.format == 'tui'):
+        print(color_val("ERROR: --stats only gets the counts, it can't be used with kill, id only, fingerprints, tui, --record or --replay!", Fore.RED + Style.BRIGHT))
+        sys.exit(1)
+
+    if args.replication is not None and (args.kill or args.id_only or args.stats or args.record or args.replay or args.format not in ('text', 'jsonl')):
+        print(color_val("ERROR: --replication only watches replication, it can't be used with kill, id only, --stats, --record, --replay or --format {0}!".format(args.format), Fore.RED + Style.BRIGHT))
+        sys.exit(1)
+
+    if args.agent and (args.kill or args.id_only or args.stats or args.locks or args.attach or MULTI_HOST or args.format != 'text'):
+        print(color_val("ERROR: --agent only polls, it can't be used with kill, id only, --stats, --locks, --attach, multiple hosts or --format {0}!".format(args.format), Fore.RED + Style.BRIGHT))
+        sys.exit(1)
+
+    if args.attach and (args.kill or args.stats or args.locks or args.record or args.replay or MULTI_HOST):
+        print(color_val("ERROR: --attach shows what the agent polls, it can't be used with kill, --stats, --locks, --record, --replay or multiple hosts!", Fore.RED + Style.BRIGHT))
+        sys.exit(1)
+
+    if args.replay and (args.kill or MULTI_HOST or args.record):
+        print(color_val("ERROR: --replay can't be used with kill, multiple hosts or --record!", Fore.RED + Style.BRIGHT))
+        sys.exit(1)
+
+    if args.config_dir and not (os.path.isdir(args.config_dir) and next(os.walk(args.config_dir))[2]):
+        ## there'd be no one to watch, and a pool of no threads
+        print(color_val("ERROR: No config files in {0} to watch!".format(args.config_dir), Fore.RED + Style.BRIGHT))
+        sys.exit(1)
+
+    if args.format == 'tui' and not HAS_CURSES:
+        print(color_val("ERROR: Unable to import curses!", Fore.RED + Style.BRIGHT))
+        sys.exit(1)
+
+    if args.kill_policy and (args.kill_roots or args.kill_fingerprint or args.kill_all):
+        print(color_val("ERROR: --kill_policy says what to kill, it can't be used with --kill_roots, --kill_fingerprint or --kill_all!", Fore.RED + Style.BRIGHT))
+        sys.exit(1)
+
+    if args.kill_dry_run:
+        if not args.kill_policy:
+            print(color_val("ERROR: --kill_dry_run needs a --kill_policy to try out!", Fore.RED + Style.BRIGHT))
+            sys.exit(1)
+        ## goes down the kill path, but nothing is killed so there's nothing to ask about
+        args.kill       = True
+        args.kill_yes   = True
+
+    if args.kill_roots:
+        if not args.kill:
+            print(color_val("ERROR: --kill_roots picks what --kill kills, it does nothing without it!", Fore.RED + Style.BRIGHT))
+            sys.exit(1)
+        args.locks = True
 
     if args.default:
-        where.append("(command = 'Query' OR command = 'Connect')")
         args.loop_second_interval   = 3
         args.ignore_system_user     = True
         args.trim_info              = True
-        order_by                    = ['time ASC', 'id ASC']
-    else:
-        if args.command:
-            where.append("command = '{0}'".format(args.command))
-        if args.state:
-            where.append("state = '{0}'".format(args.state))
-        if args.time:
-            where.append("time >= {0}".format(args.time))
-        if args.database:
-            where.append("db = '{0}'".format(args.database))
-        if args.query:
-            where.append("info LIKE '{0}%'".format(args.query))
-        if args.order_by:
-            order_by.append(args.order_by)
-        USER_WHERE = list(where)
 
-    if args.kill and not where:
-        print(color_val("ERROR: Cannot kill without specifying criteria!", Fore.RED + Style.BRIGHT))
-        sys.exit(1)
+    if OUTPUT.live and args.loop_second_interval <= 0:
+        ## a live view that draws once isn't much of one
+        args.loop_second_interval   = 3
 
-    where.append("command != 'Binlog Dump'")
-    where.append("(db != 'information_schema' OR db IS NULL)") ## confuses me why I had to add OR db IS NULL
+    if args.loop_min is not None or args.loop_max is not None:
+        ## only the process list loop adapts, the agent, replication and replay keep their own pace
+        if args.loop_second_interval <= 0 or args.agent or args.attach or args.replay or args.replication is not None:
+            print(color_val("ERROR: --loop_min and --loop_max adapt --loop, they can't be used without it, or with --agent, --attach, --replay or --replication!", Fore.RED + Style.BRIGHT))
+            sys.exit(1)
+        low     = args.loop_min if args.loop_min is not None else args.loop_second_interval
+        high    = args.loop_max if args.loop_max is not None else args.loop_second_interval
+        if not 0 < low <= args.loop_second_interval <= high:
+            print(color_val("ERROR: --loop_min ({0:g}) has to be above 0 and no more than --loop ({1}), and --loop_max ({2:g}) no less than it!".format(
+                low, args.loop_second_interval, high), Fore.RED + Style.BRIGHT))
+            sys.exit(1)
 
-    if args.ignore_system_user == True:
-        where.append("user != 'system user'")
+    if args.kill:
+        if not args.kill_yes:
+            ans = raw_input(color_val("Are you sure you want to kill queries? ", Style.BRIGHT))
+            if ans.lower() not in ('y', 'yes'):
+                print("Ok, then only use --kill when you are sure you want to kill stuff.")
+                sys.exit(0)
+
+    if args.format == 'prometheus':
+        if args.fingerprints:
+            OUTPUT.top  = args.fingerprints
+        try:
+            OUTPUT.serve(args.metrics_listen)
+        except (ValueError, socket.error) as e:
+            print(color_val("ERROR: Unable to listen on {0}: {1}".format(args.metrics_listen, e), Fore.RED + Style.BRIGHT))
+            sys.exit(1)
 
-    if where:
-        where_str = ' WHERE {0}'.format(' AND '.join(where))
+    if args.replay:
+        return replay()
 
-    if order_by:
-        order_by_str = ' ORDER BY {0}'.format(', '.join(order_by))
+    if args.attach:
+        return attach()
 
-    sql = ''.join([sql, where_str, order_by_str])
+    if args.replication is not None:
+        return watch_replication()
 
-    if args.debug:
-        show_processing_time(PROG_START, time.time(), 'Program Preparation')
-        print("SQL: {0}".format(color_val(sql, Fore.CYAN)))
+    if args.record:
+        ## an --agent records what it polls too, it's all the same take_snapshot()
+        global RECORDER
+        RECORDER = snapshot_recorder(args.record)
+        if not RECORDER.open():
+            sys.exit(1)
+
+    if args.agent:
+        return run_agent()
+
+    if MULTI_HOST:
+        watchers    = get_host_watchers()
+        conns       = lambda: [c for w in watchers for c in w.conn.connections()]
+        ## one thread per host, so a tick takes as long as the slowest host rather than all of them added up.
+        from multiprocessing.pool import ThreadPool
+        pool        = ThreadPool(len(watchers))
+        poll        = lambda counter=0: pslist_hosts(watchers, pool, counter)
+    else:
+        source      = get_process_source(args.source)
+        query       = build_query(source)
+        poll        = lambda counter=0: pslist(query, counter)
+        conns       = db.connections
+
+        if args.format == 'prometheus':
+            ## an exporter has to report the server down rather than wait it out (or exit) inside a tick.
+            ## Only from here, not reaching it at all is still a configuration problem.
+            db.exit_on_error    = False
+            db.label            = get_hostname()
+            poll                = lambda counter=0: pslist_exporter(query, counter)
+
+        if args.debug:
+            show_processing_time(PROG_START, time.time(), 'Program Preparation')
+            print("Server: {0} ({1})".format(color_val(get_metadata('version'), Fore.CYAN), db.meta.flavor))
+            print("Source: {0}".format(color_val(source.name, Fore.CYAN)))
+            print("SQL: {0}".format(color_val(query.sql, Fore.CYAN)))
+            print("Parameters: {0}".format(color_val(', '.join(repr(p) for p in query.params), Fore.CYAN)))
 
     if args.loop_second_interval > 0:
-        counter = 0
+        global SCHEDULER
+        SCHEDULER   = tick_scheduler(args.loop_second_interval, args.loop_min, args.loop_max)
+        counter     = 0
         while 1:
             counter += 1
-            if pslist(sql, counter):
+            SCHEDULER.start()
+            start = time.time()
+            if poll(counter):
                 counter = 0
+            TIMINGS.add('total', time.time() - start)
+            TIMINGS.end_tick()
 
-            time.sleep(args.loop_second_interval)
+            idle(SCHEDULER.next(), conns)
     else:
-        pslist(sql)
+        poll()
 
 ## ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-if not HAS_COLOR:
-    print("ERROR: Unable to import colorama!")
-    sys.exit(1)
+if __name__ == "__main__":
+    if not HAS_COLOR and sys.stdout.isatty():
+        print("ERROR: Unable to import colorama!")
+        sys.exit(1)
 
-init()
+    if HAS_COLOR:
+        init()
 
-if not HAS_MYSQL:
-    print(color_val("ERROR: Unable to import pymysql!", Fore.RED + Style.BRIGHT))
-    sys.exit(1)
+    signal.signal(signal.SIGINT, sig_handler)
+    if hasattr(signal, 'SIGUSR2'):
+        ## not SIGHUP, closing the terminal still has to end the watch
+        signal.signal(signal.SIGUSR2, refresh_metadata)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, print_timings)
 
-signal.signal(signal.SIGINT, sig_handler)
+    args    = parse_args()
 
-args    = parse_args()
+    ## only now that we know what's wanted. --help and tab completion never get this far.
+    try:
+        import pymysql
+        from pymysql.constants import CLIENT, CR
+    except ImportError:
+        print(color_val("ERROR: Unable to import pymysql!", Fore.RED + Style.BRIGHT))
+        sys.exit(1)
 
-if not HAS_YAML and args.connect_config:
-    print(color_val('ERROR: Unable to import yaml! You will not be able to use the config option.', Fore.RED + Style.BRIGHT))
-    sys.exit(1)
+    if args.connect_config or args.config_dir or args.kill_policy:
+        try:
+            import yaml
+        except ImportError:
+            print(color_val('ERROR: Unable to import yaml! You will not be able to use the config or kill policy options.', Fore.RED + Style.BRIGHT))
+            sys.exit(1)
 
-db      = mydb()
+    HAS_CURSES = False
+    if args.format == 'tui':
+        ## no curses on windows
+        try:
+            import curses
+            HAS_CURSES = True
+        except ImportError:
+            pass
 
-LONG_QUERY_TIME     = get_long_query_time()
+    TIMINGS     = stage_timings()
+    MULTI_HOST  = bool(args.hosts or args.config_dir)
+    OUTPUT      = get_output(args.format)
+    POLICY      = load_kill_policy(args.kill_policy) if args.kill_policy else None
+    db          = mydb() if not MULTI_HOST else None
 
-if __name__ == "__main__":
     main()
-
-
-
-
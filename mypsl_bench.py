@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+
+'''
+    mypsl_bench :: how long mypsl.py takes to do what it does
+    Copyright (C) 2014 Kyle Shenk <k.shenk@gmail.com>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import print_function
+import os
+import sys
+import argparse
+import json
+import random
+import shlex
+import subprocess
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+HERE    = os.path.dirname(os.path.abspath(__file__))
+MYPSL   = os.path.join(HERE, 'mypsl.py')
+
+## what every mypsl.py run used to import before it knew whether it needed any of it
+EAGER_IMPORTS = ('pymysql', 'colorama', 'yaml', 'argcomplete', 'subprocess', 'distutils.spawn')
+
+## mypsl.py run as its own __main__, but with pymysql.connect handing back a standin_conn
+STANDIN_RUNNER  = "import sys; sys.path.insert(0, {0!r}); import mypsl_bench; mypsl_bench.run_standin({1!r})"
+STANDIN_ROWS    = 100
+
+def median(vals):
+    vals = sorted(vals)
+    return vals[len(vals) // 2]
+
+def run_times(cmd, runs):
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            start = time.time()
+            subprocess.call(cmd, stdout=devnull, stderr=devnull, cwd=HERE)
+            times.append(time.time() - start)
+    return times
+
+def call_times(func, runs):
+    times = []
+    for i in range(runs):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return times
+
+def report(name, times):
+    print("{0:<45} median: {1:>8.2f}ms  min: {2:>8.2f}ms  ({3} runs)".format(name, median(times) * 1000, min(times) * 1000, len(times)))
+
+def load_mypsl():
+    ## importing mypsl.py doesn't run anything, everything's under its __main__
+    sys.path.insert(0, HERE)
+    import mypsl
+    return mypsl
+
+def bench_startup(args):
+    python  = sys.executable
+    eager   = '; '.join("exec('try:\\n import {0}\\nexcept Exception:\\n pass')".format(m) for m in EAGER_IMPORTS)
+
+    print("-- process startup")
+    report('python -c pass', run_times([python, '-c', 'pass'], args.runs))
+    report('the old eager imports', run_times([python, '-c', eager], args.runs))
+    report('mypsl.py -i, stand-in server', run_times([python, '-c', STANDIN_RUNNER.format(HERE, ['-H', '127.0.0.1', '-i'])], args.runs))
+    report('mypsl.py --help', run_times([python, MYPSL, '--help'], args.runs))
+
+    mypsl   = load_mypsl()
+    my_cnf  = args.my_cnf or mypsl.find_my_cnf()
+    if not my_cnf:
+        print("-- no my.cnf found, skipping the socket lookup (see --my_cnf)")
+        return
+    mypsl.find_my_cnf = lambda: my_cnf
+
+    print("-- socket lookup in {0}".format(my_cnf))
+    my_print_defaults = None
+    for d in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(d, 'my_print_defaults'), os.X_OK):
+            my_print_defaults = os.path.join(d, 'my_print_defaults')
+            break
+    if my_print_defaults:
+        report('my_print_defaults (what it used to fork)', run_times([my_print_defaults, '--defaults-file', my_cnf, 'mysqld'], args.runs))
+    report('read_my_cnf()', call_times(lambda: mypsl.read_my_cnf(my_cnf, []), args.runs))
+    mypsl.get_mysql_default('socket')
+    report("get_mysql_default('socket'), cached", call_times(lambda: mypsl.get_mysql_default('socket'), args.runs))
+
+## what the synthetic process lists are made of
+SYNTH_USERS     = ('app', 'web', 'reporting', 'batch', 'repl', 'system user')
+SYNTH_DBS       = ('shop', 'logs', 'users', None)
+SYNTH_STATES    = ('Sending data', 'executing', 'Locked', 'Waiting for table metadata lock', 'Copying to tmp table on disk',
+                   'Opening tables', 'closing tables', 'statistics', 'Sorting result', 'updating', None)
+SYNTH_CHURN     = .1    ## the part of the threads replaced each tick
+
+def synth_info(rnd, n):
+    ## mostly short, some long IN lists, a few huge multi-row inserts
+    r = rnd.random()
+    if r < .6:
+        return "SELECT id, name, price FROM products WHERE id = {0} AND status = 'live'".format(n)
+    if r < .75:
+        return "UPDATE carts SET updated = NOW(), total = {0} WHERE user_id = {1}".format(rnd.randint(1, 999), n)
+    if r < .95:
+        return "SELECT * FROM orders WHERE customer_id IN ({0}) ORDER BY created DESC".format(
+            ', '.join(str(rnd.randint(1, 10 ** 6)) for i in range(rnd.randint(100, 800))))
+    return "INSERT INTO events (user_id, kind, payload) VALUES {0}".format(
+        ', '.join("({0}, 'click', '{1}')".format(rnd.randint(1, 10 ** 6), 'x' * rnd.randint(10, 200)) for i in range(rnd.randint(100, 500))))
+
+def synth_row(rnd, thread_id):
+    if rnd.random() < .4:
+        return {'id': thread_id, 'user': rnd.choice(SYNTH_USERS), 'host': '10.0.{0}.{1}:{2}'.format(rnd.randint(0, 9), rnd.randint(1, 254), rnd.randint(1024, 65535)),
+            'db': rnd.choice(SYNTH_DBS), 'command': 'Sleep', 'time': rnd.randint(0, 600), 'state': '', 'info': None}
+    return {'id': thread_id, 'user': rnd.choice(SYNTH_USERS), 'host': '10.0.{0}.{1}:{2}'.format(rnd.randint(0, 9), rnd.randint(1, 254), rnd.randint(1024, 65535)),
+        'db': rnd.choice(SYNTH_DBS), 'command': 'Query', 'time': rnd.randint(0, 120), 'state': rnd.choice(SYNTH_STATES),
+        'info': synth_info(rnd, thread_id)}
+
+def synthetic_ticks(rows, ticks, seed=1):
+    '''
+        Generated process lists: `rows` threads per tick, the same threads carrying on from one tick to the next
+        a second older, with some of them finishing and new ones taking their place.
+    '''
+    rnd     = random.Random(seed)
+    next_id = 1000
+    threads = []
+    for i in range(rows):
+        threads.append(synth_row(rnd, next_id))
+        next_id += 1
+    for t in range(ticks):
+        yield threads
+        carried = []
+        for row in threads:
+            if rnd.random() < SYNTH_CHURN:
+                carried.append(synth_row(rnd, next_id))
+                next_id += 1
+            else:
+                row = dict(row)
+                row['time'] += 1
+                carried.append(row)
+        threads = carried
+
+def jsonl_ticks(path):
+    '''
+        Process lists recorded with mypsl.py --format jsonl, a tick per summary record.
+    '''
+    rows = []
+    with open(path, 'r') as f:
+        for line in f:
+            rec = json.loads(line)
+            if rec.get('type') == 'process':
+                rows.append(dict((k, rec.get(k)) for k in ('id', 'user', 'host', 'db', 'command', 'time', 'state', 'info')))
+            elif rec.get('type') == 'summary':
+                yield rows
+                rows = []
+    if rows:
+        yield rows
+
+class synthetic_cursor():
+    def __init__(self, sets):
+        self.sets   = list(sets)
+        self.rows   = self.sets.pop(0) if self.sets else None
+        self.pos    = 0
+
+    def nextset(self):
+        if not self.sets:
+            self.rows = None
+            return None
+        self.rows   = self.sets.pop(0)
+        self.pos    = 0
+        return True
+
+    def fetchall(self):
+        rows        = self.rows[self.pos:] if self.rows else ()
+        self.pos    = len(self.rows or ())
+        return rows
+
+    def fetchone(self):
+        if not self.rows or self.pos >= len(self.rows):
+            return None
+        self.pos += 1
+        return self.rows[self.pos - 1]
+
+    def fetchall_unbuffered(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def close(self):
+        pass
+
+class standin_conn():
+    '''
+        Enough of a pymysql connection for one-off mypsl.py runs: it answers the source probe, the status and
+        variables, and the process list with STANDIN_ROWS generated threads. Everything else gets no result set.
+    '''
+    def __init__(self, **kwargs):
+        self.threads = next(synthetic_ticks(STANDIN_ROWS, 1))
+
+    def cursor(self, *args):
+        return standin_cursor(self)
+
+    def answer(self, stmt):
+        if stmt.startswith('SELECT @@global.performance_schema'):
+            return [{'performance_schema': 1, 'tables': 'performance_schema.threads,sys.x$processlist'}]
+        if stmt.startswith('SHOW GLOBAL STATUS'):
+            return [{'Variable_name': 'Threads_connected', 'Value': str(len(self.threads))},
+                    {'Variable_name': 'Threads_running', 'Value': str(sum(1 for r in self.threads if r['command'] != 'Sleep'))}]
+        if stmt.startswith('SELECT') and '@@' in stmt and 'FROM' not in stmt:
+            return [{'max_connections': 151, 'long_query_time': 10.0, 'hostname': 'standin', 'version': '8.0.36', 'version_comment': 'stand-in'}]
+        if stmt.startswith('SELECT'):
+            return [dict(r) for r in self.threads]
+        return None
+
+    def ping(self, reconnect=False):
+        return True
+
+    def close(self):
+        pass
+
+class standin_cursor(synthetic_cursor):
+    def __init__(self, conn):
+        synthetic_cursor.__init__(self, [])
+        self.conn = conn
+
+    def execute(self, sql, args=None):
+        synthetic_cursor.__init__(self, [self.conn.answer(stmt.strip()) for stmt in sql.split(';\n')])
+
+def run_standin(argv):
+    '''
+        mypsl.py as its own __main__ against a standin_conn, for timing whole runs. pymysql gets imported
+        here rather than by mypsl.py, which every run that connects does anyway.
+    '''
+    import pymysql
+    import runpy
+    pymysql.connect = pymysql.Connect = standin_conn
+    sys.argv = [MYPSL] + list(argv)
+    runpy.run_path(MYPSL, run_name='__main__')
+
+def make_synthetic_db(mypsl, source):
+    '''
+        A mydb that answers from whatever process list it was last given rather than a server.
+        It answers the statements mypsl sends the way the server would, the rows as fresh dicts, like the driver hands them over.
+        It doesn't apply the WHERE clause, every row comes back. KILLs are counted and otherwise ignored.
+    '''
+    class synthetic_db(mypsl.mydb):
+        def __init__(self):
+            self.host           = 'synthetic'
+            self.meta           = mypsl.metadata_cache()
+            self.connect_args   = {}
+            self.conn           = True
+            self.threads        = []
+            self.trimmed        = False
+            self.killed         = []    ## shared with the kill pool's clones
+            self.full_info      = source.select_sql(['id', 'info'])
+
+        def connect(self):
+            self.conn = True
+
+        def ensure(self):
+            self.conn = True
+
+        def feed(self, threads):
+            self.threads = threads
+
+        def process_rows(self):
+            if not self.trimmed:
+                return [dict(r) for r in self.threads]
+            rows = []
+            for r in self.threads:
+                ## what LEFT(), CHAR_LENGTH() and the keyword expression give back
+                row = dict(r)
+                info = r['info']
+                row['info']         = info[:mypsl.INFO_TRIM_LENGTH] if info else info
+                row['info_length']  = len(info) if info is not None else None
+                row['info_keyword'] = info.split(None, 1)[0].lower() if info and info.split() else None
+                rows.append(row)
+            return rows
+
+        def answer(self, stmt, args):
+            if stmt.startswith('SHOW GLOBAL STATUS'):
+                running = sum(1 for r in self.threads if r['command'] != 'Sleep')
+                return [{'Variable_name': 'Threads_connected', 'Value': str(len(self.threads))},
+                        {'Variable_name': 'Threads_running', 'Value': str(running)}]
+            if stmt.startswith('SELECT @@') or (stmt.startswith('SELECT') and '@@' in stmt and 'FROM' not in stmt):
+                return [{'max_connections': max(len(self.threads) * 2, 151), 'long_query_time': 10.0, 'hostname': 'synthetic',
+                         'version': '8.0.36', 'version_comment': 'synthetic'}]
+            if stmt.startswith(('SET ', 'PREPARE ', 'DEALLOCATE ', 'DO ')):
+                return None
+            if stmt.startswith('KILL'):
+                self.killed.append(args)
+                return None
+            if stmt.startswith(self.full_info):
+                wanted = set(args or ())
+                return [{'id': r['id'], 'info': r['info']} for r in self.threads if r['id'] in wanted]
+            return self.process_rows()
+
+        def query(self, sql, args=[], reconnect=True, unbuffered=False):
+            self.num_queries += 1
+            return synthetic_cursor([self.answer(stmt.strip(), args) for stmt in sql.split(';\n')])
+
+        def probe(self, sql):
+            return None
+
+    return synthetic_db()
+
+def pipeline_run(mypsl, ticks, argv):
+    '''
+        Every tick goes through pslist(), the whole thing: take_snapshot(), process_row(), the output and
+        killah() when killing, with the output going to /dev/null.
+    '''
+    sys.argv        = ['mypsl.py', '-H', 'synthetic'] + argv
+    mypsl.args      = mypsl.parse_args()
+    mypsl.args.loop_second_interval = mypsl.args.loop_second_interval or 1    ## prepared statements, like a real loop
+    mypsl.TIMINGS   = mypsl.stage_timings()
+    mypsl.MULTI_HOST = False
+    mypsl.OUTPUT    = mypsl.get_output(mypsl.args.format)
+    mypsl.db        = None
+
+    source          = mypsl.get_process_source(mypsl.args.source if mypsl.args.source != 'auto' else 'performance_schema')
+    db              = mypsl.db = make_synthetic_db(mypsl, source)
+    query           = mypsl.build_query(source)
+    db.trimmed      = 'info_keyword' in query.sql
+
+    latencies       = []
+    nrows           = 0
+    stdout          = sys.stdout
+    sys.stdout      = open(os.devnull, 'w')
+    try:
+        for (i, threads) in enumerate(ticks):
+            db.feed(threads)
+            start = time.time()
+            mypsl.pslist(query, i)
+            mypsl.TIMINGS.end_tick()
+            latencies.append(time.time() - start)
+            nrows += len(threads)
+
+        peak = None
+        if tracemalloc and threads:
+            ## one more tick of the last process list, traced, for the memory a tick needs at its worst
+            db.feed(threads)
+            tracemalloc.start()
+            mypsl.pslist(query, 0)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return (latencies, nrows, peak, len(db.killed))
+
+def bench_pipeline(args):
+    mypsl   = load_mypsl()
+    argv    = shlex.split(args.mypsl_args or '')
+    if args.kill:
+        argv += ['--kill', '-ky', '-ka', '-kt', 'off', '-kl', os.devnull]
+
+    if args.replay:
+        runs = [(args.replay, list(jsonl_ticks(args.replay)))]
+    else:
+        runs = [("{0} rows".format(n), synthetic_ticks(n, args.ticks, args.seed)) for n in args.rows]
+
+    print("-- pipeline: mypsl.py {0}".format(' '.join(argv)))
+    for (name, ticks) in runs:
+        (latencies, nrows, peak, kills) = pipeline_run(mypsl, ticks, argv)
+        total = sum(latencies)
+        print("{0:<16} ticks: {1:<5} rows/sec: {2:>10.0f}  tick p50: {3:>9.2f}ms  p95: {4:>9.2f}ms  max: {5:>9.2f}ms  peak tick memory: {6}{7}".format(
+            name, len(latencies), nrows / total if total else 0, median(latencies) * 1000,
+            sorted(latencies)[min(int(len(latencies) * .95), len(latencies) - 1)] * 1000, max(latencies) * 1000,
+            "{0:.1f}MB".format(peak / 1024.0 / 1024) if peak is not None else 'n/a',
+            "  kills: {0}".format(kills) if args.kill else ''))
+    if resource:
+        ## KB on linux, bytes on mac
+        print("-- max RSS: {0}".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks for mypsl.py.')
+    sub = parser.add_subparsers(dest='bench')
+    sub.required = True
+
+    startup = sub.add_parser('startup', help='How long it takes mypsl.py to get going, and what it saves by not importing everything up front.')
+    startup.add_argument('-n', '--runs', dest='runs', type=int, default=20,
+        help='Times to run each one.')
+    startup.add_argument('--my_cnf', dest='my_cnf', type=str,
+        help='The my.cnf to time the socket lookup against, default is the one mypsl.py would find.')
+    startup.set_defaults(func=bench_startup)
+
+    pipeline = sub.add_parser('pipeline', help='Process lists through pslist(), process_row() and killah() with no server: rows/sec, tick latency and memory.')
+    pipeline.add_argument('-r', '--rows', dest='rows', type=lambda v: [int(n) for n in v.split(',')], default=[10, 1000, 10000, 100000],
+        help='Comma separated process list sizes to generate, one run each. Default: 10,1000,10000,100000')
+    pipeline.add_argument('-t', '--ticks', dest='ticks', type=int, default=20,
+        help='Ticks per run.')
+    pipeline.add_argument('--seed', dest='seed', type=int, default=1,
+        help='Seed for the generated process lists, the same seed gives the same lists.')
+    pipeline.add_argument('--replay', dest='replay', type=str,
+        help='Replay process lists captured with mypsl.py --format jsonl instead of generating them.')
+    pipeline.add_argument('--kill', dest='kill', action='store_true',
+        help='Kill everything every tick, with the KILLs going nowhere.')
+    pipeline.add_argument('-a', '--mypsl_args', dest='mypsl_args', type=str,
+        help='Options for mypsl.py, as one string. e.g. "--history 5 -fp 10 --format jsonl"')
+    pipeline.set_defaults(func=bench_pipeline)
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)